@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+import cPickle
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy
+
+from logger import get_logger
+
+
+log = get_logger()
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DISK_SUFFIX = '.pkl.z'
+# number of items of a long list sized to estimate the size of the whole list
+SIZE_SAMPLE = 100
+
+
+def sizeof(value, sample=SIZE_SAMPLE):
+    """
+    Approximate memory held by a value: containers, strings, numbers and numpy arrays (a view counts its
+    share of the data).  Dictionary keys are not counted, the decoded records share them.  Long lists and
+    tuples are estimated from an evenly spaced sample of their items.
+    :param value:  value to size
+    :param sample:  maximum number of items sized per list
+    :return: size in bytes
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, numpy.ndarray):
+        if not value.flags.owndata:
+            size += value.nbytes
+    elif isinstance(value, dict):
+        size += sum(sizeof(v, sample) for v in value.itervalues())
+    elif isinstance(value, (list, tuple)) and value:
+        step = max(1, len(value) // sample)
+        items = value[::step]
+        size += sum(sizeof(v, sample) for v in items) * len(value) // len(items)
+    return size
+
+
+class ResultsCache(object):
+    """
+    LRU cache of retrieved EDEX results, bounded by the (approximate) in-memory size of the cached values.
+    When a cache directory is supplied, entries are also written to disk as compressed pickles so that
+    later runs against the same EDEX can reuse them.
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries or os.path.exists(self._disk_path(key))
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Fetch an entry from memory, falling back to the disk tier
+        :param key:  cache key
+        :param default:  value returned on a cache miss
+        :return: cached value or default
+        """
+        with self._lock:
+            if key in self._entries:
+                value, nbytes = self._entries.pop(key)
+                self._entries[key] = (value, nbytes)
+                self.hits += 1
+                log.debug('results cache hit: %r', key)
+                return value
+
+        value, nbytes = self._read(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                log.debug('results cache miss: %r', key)
+                return default
+
+            self.disk_hits += 1
+            log.debug('results cache disk hit: %r', key)
+            self._store(key, value, nbytes)
+            return value
+
+    def put(self, key, value, nbytes=None):
+        """
+        Add an entry to the cache, evicting the least recently used entries to stay within max_bytes
+        :param key:  cache key
+        :param value:  value to cache (must be picklable when a cache directory is used)
+        :param nbytes:  in-memory size of the entry, estimated with sizeof if not supplied
+        """
+        if nbytes is None:
+            nbytes = sizeof(value)
+
+        if self.cache_dir is not None:
+            self._write(key, cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+
+        with self._lock:
+            self._store(key, value, nbytes)
+
+    def discard(self, key):
+        """
+        Remove an entry from memory (the disk tier is left intact)
+        """
+        with self._lock:
+            if key in self._entries:
+                _, nbytes = self._entries.pop(key)
+                self.size -= nbytes
+
+    def clear(self, disk=True):
+        """
+        Invalidate all entries
+        :param disk:  also remove entries from the disk tier
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+            if disk and self.cache_dir is not None and os.path.isdir(self.cache_dir):
+                for filename in os.listdir(self.cache_dir):
+                    if filename.endswith(DISK_SUFFIX):
+                        try:
+                            os.remove(os.path.join(self.cache_dir, filename))
+                        except OSError as e:
+                            log.warn('unable to remove cache file %s - %s', filename, e)
+        log.info('results cache cleared')
+        self.log_stats()
+
+    def log_stats(self):
+        log.info('results cache: %d entries (%d bytes) hits=%d disk_hits=%d misses=%d evictions=%d',
+                 len(self._entries), self.size, self.hits, self.disk_hits, self.misses, self.evictions)
+
+    def _store(self, key, value, nbytes):
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+
+        if nbytes > self.max_bytes:
+            log.info('results cache: not keeping %r in memory (%d bytes exceeds limit of %d)',
+                     key, nbytes, self.max_bytes)
+            return
+
+        self._entries[key] = (value, nbytes)
+        self.size += nbytes
+
+        while self.size > self.max_bytes:
+            old_key, (_, old_bytes) = self._entries.popitem(last=False)
+            self.size -= old_bytes
+            self.evictions += 1
+            log.info('results cache evicted %r (%d bytes) hits=%d misses=%d evictions=%d',
+                     old_key, old_bytes, self.hits, self.misses, self.evictions)
+
+    def _disk_path(self, key):
+        if self.cache_dir is None:
+            return ''
+        return os.path.join(self.cache_dir, hashlib.sha1(repr(key)).hexdigest() + DISK_SUFFIX)
+
+    def _read(self, key):
+        path = self._disk_path(key)
+        if not path or not os.path.exists(path):
+            return None, 0
+
+        try:
+            with open(path, 'rb') as fh:
+                data = zlib.decompress(fh.read())
+            value = cPickle.loads(data)
+            return value, sizeof(value)
+        except (IOError, EOFError, zlib.error, cPickle.UnpicklingError) as e:
+            log.warn('unable to read results cache file %s - %s', path, e)
+            return None, 0
+
+    def _write(self, key, data):
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+        except OSError:
+            # created by another thread
+            pass
+
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(zlib.compress(data, 1))
+            os.rename(temp_path, self._disk_path(key))
+        except (IOError, OSError) as e:
+            log.warn('unable to write results cache file - %s', e)
@@ -1,4 +1,6 @@
 #!/usr/bin/env python
+import atexit
+import codecs
 import glob
 import os
 
@@ -6,13 +8,27 @@ import pprint
 import math
 import ntplib
 import numpy
+import calendar
+import threading
 
 import qpid.messaging as qm
 import time
 import requests
+import requests.adapters
 import struct
+from collections import Counter
 from logger import get_logger
+from cache import ResultsCache
+from log_tailer import LogTailer
+from running_stats import ParameterStats, wilson_interval
+import timing
 import simplejson.scanner
+from multiprocessing.pool import ThreadPool
+
+try:
+    import xarray as xr
+except ImportError:
+    xr = None
 
 
 log = get_logger()
@@ -24,37 +40,199 @@ hdf5dir = os.path.join(edex_dir, 'data', 'hdf5', 'sensorreading')
 log_dir = os.path.join(edex_dir, 'logs')
 
 
-qpid_session = None
+sender_pools = {}
+sender_pools_lock = threading.Lock()
+http_session = None
+http_session_lock = threading.Lock()
+window_pool = None
+window_pool_lock = threading.Lock()
+log_tailers = {}
+log_tailer_lock = threading.Lock()
 user = 'guest'
 host = 'localhost'
 port = 5672
 
 DEFAULT_STANDARD_TIMEOUT = 60
 
+# maximum number of unacknowledged messages per sender, 0 for synchronous sends
+QPID_SEND_WINDOW = 100
+
 EDEX_BASE_URL = 'http://%s:12575/sensor/inv/%s/%s/%s'
 
-results_cache = {}
+STREAMING_CHUNK_SIZE = 1024 * 1024
+STREAMING_BATCH_SIZE = 1000
+
+MAX_RETRIEVAL_WINDOWS = 16
+
+MIO_CHUNK_SIZE = 10000
+
+# number of differing array elements reported by same_array
+MAX_REPORTED_DIFFERENCES = 5
+
+# record keys held as global attributes in retrieved NetCDF files
+NETCDF_ATTRIBUTES = {'stream_name': 'stream'}
+
+# maximum difference (in milliseconds) between matching expected and retrieved timestamps
+DEFAULT_TIME_TOLERANCE_MS = 1
+
+RESULTS_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# sampled validation: time bins the expected records are stratified by,
+# seconds retrieved either side of each sampled record
+SAMPLE_BINS = 10
+SAMPLE_WINDOW = 1
+
+results_cache = ResultsCache(max_bytes=RESULTS_CACHE_MAX_BYTES, cache_dir=os.getenv('EDEX_RESULTS_CACHE'))
+
+
+class QpidSenderPool(object):
+    """
+    Sends messages to a qpid broker using one session per thread and one cached sender per queue.
+    Sends are asynchronous with at most window messages in flight per sender, call sync() to wait for
+    all outstanding messages to be acknowledged.
+    """
+    def __init__(self, hostname=None, window=QPID_SEND_WINDOW):
+        self.hostname = hostname
+        self.window = window
+        self.connection = None
+        self.sent = 0
+        self.start_time = None
+        self._sessions = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def session(self):
+        """
+        :return: qpid session owned by the calling thread
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            with self._lock:
+                if self.connection is None:
+                    self.connection = qm.Connection(host=self.hostname or host, port=port,
+                                                    username=user, password=user)
+                    self.connection.open()
+                session = self.connection.session()
+                self._sessions.append(session)
+            self._local.session = session
+            self._local.senders = {}
+        return session
+
+    def sender(self, queue):
+        session = self.session()
+        sender = self._local.senders.get(queue)
+        if sender is None:
+            sender = session.sender(queue)
+            if self.window:
+                sender.capacity = self.window
+            self._local.senders[queue] = sender
+        return sender
+
+    def send(self, queue, message, sync=False):
+        """
+        Send a message, blocking only when the sender's in-flight window is full (or sync is requested)
+        """
+        sender = self.sender(queue)
+        with self._lock:
+            if self.start_time is None:
+                self.start_time = time.time()
+            self.sent += 1
+        sender.send(message, sync=sync or not self.window)
+
+    def sync(self, timeout=None):
+        """
+        Wait for all messages sent from every session to be acknowledged and report the send rate
+        """
+        with self._lock:
+            sessions = list(self._sessions)
+            sent, start_time = self.sent, self.start_time
+            self.sent = 0
+            self.start_time = None
+
+        for session in sessions:
+            session.sync(timeout=timeout)
+
+        if sent:
+            elapsed = time.time() - start_time
+            log.info('Sent %d messages in %.2f secs (%.1f sends/sec)', sent, elapsed, sent / max(elapsed, 1e-6))
+
+
+def get_sender_pool(hostname=None):
+    """
+    Fetch the sender pool for a qpid broker
+    :param hostname:  broker host, defaults to the module host
+    :return:  QpidSenderPool
+    """
+    hostname = hostname or host
+    with sender_pools_lock:
+        if hostname not in sender_pools:
+            sender_pools[hostname] = QpidSenderPool(hostname)
+        return sender_pools[hostname]
 
 
 def get_qpid():
-    global qpid_session
-    if qpid_session is None:
-        conn = qm.Connection(host=host, port=port, username=user, password=user)
-        conn.open()
-        qpid_session = conn.session()
-    return qpid_session
+    return get_sender_pool().session()
+
+
+def sync_queues(timeout=None):
+    """
+    Wait for all asynchronously sent messages to be acknowledged
+    """
+    with sender_pools_lock:
+        pools = sender_pools.values()
+    for pool in pools:
+        pool.sync(timeout=timeout)
 
 
 def purge_edex(table='PURGE_ALL_DATA'):
     purge_message = qm.Message(content=table, content_type='text/plain', user_id=user)
     log.info('Purging edex')
-    get_qpid().sender('purgeCass').send(purge_message)
+    get_sender_pool().send('purgeCass', purge_message, sync=True)
+    results_cache.clear()
 
 
-def send_file_to_queue(filename, queue, delivery_type, sensor, deploymentNumber):
+def send_file_to_queue(filename, queue, delivery_type, sensor, deploymentNumber, hostname=None):
+    """
+    Send a file to an ingest queue.  The send is asynchronous, call sync_queues once all files have been sent.
+    :param hostname:  broker host, defaults to the module host
+    """
     props = {'deliveryType': delivery_type, 'sensor': sensor, 'deploymentNumber': deploymentNumber}
     ingest_message = qm.Message(content=filename, content_type='text/plain', user_id=user, properties=props)
-    get_qpid().sender(queue).send(ingest_message)
+    get_sender_pool(hostname).send(queue, ingest_message)
+
+
+def get_http_session():
+    """
+    Shared requests session, pooling connections for concurrent retrievals
+    """
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=MAX_RETRIEVAL_WINDOWS)
+            http_session.mount('http://', adapter)
+    return http_session
+
+
+def get_window_pool():
+    """
+    Thread pool shared by all windowed retrievals, bounding the concurrent window requests
+    """
+    global window_pool
+    with window_pool_lock:
+        if window_pool is None:
+            window_pool = ThreadPool(MAX_RETRIEVAL_WINDOWS)
+            atexit.register(close_window_pool)
+    return window_pool
+
+
+def close_window_pool():
+    global window_pool
+    with window_pool_lock:
+        pool, window_pool = window_pool, None
+    if pool is not None:
+        pool.close()
+        pool.join()
 
 
 def ntptime_to_string(t):
@@ -64,6 +242,18 @@ def ntptime_to_string(t):
     return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t)) + millis + 'Z'
 
 
+def string_to_ntptime(s):
+    """
+    Convert a uFrame time string (e.g. '2014-05-10T19:10:51.794Z') to NTP time
+    """
+    s = s.rstrip('Z')
+    seconds, _, fraction = s.partition('.')
+    t = calendar.timegm(time.strptime(seconds, '%Y-%m-%dT%H:%M:%S'))
+    if fraction:
+        t += float('.' + fraction)
+    return ntplib.system_to_ntp_time(t)
+
+
 def get_record_json(record):
     """
     Perform a safe fetch of JSON data from the supplied data record.
@@ -76,8 +266,98 @@ def get_record_json(record):
         return []
 
 
+def iter_record_json(response, chunk_size=STREAMING_CHUNK_SIZE):
+    """
+    Incrementally decode the JSON list of records in a streamed (stream=True) response.
+    As with get_record_json, data which can not be decoded is logged and skipped.
+    :param response:  requests response opened with stream=True
+    :param chunk_size:  number of bytes to read from the response at a time
+    :return: generator of JSON records
+    """
+    decoder = simplejson.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+    chunks = response.iter_content(chunk_size)
+    buf = u''
+    pos = 0
+    eof = False
+    need_more = True
+    in_list = False
+
+    while True:
+        if need_more and not eof:
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                chunk = b''
+                eof = True
+            buf = buf[pos:] + text_decoder.decode(chunk, final=eof)
+            pos = 0
+            need_more = False
+
+        # skip whitespace and list separators between records
+        while pos < len(buf) and buf[pos] in u' \t\r\n,':
+            pos += 1
+
+        if pos == len(buf):
+            if eof:
+                if in_list:
+                    log.warn('unable to decode record as JSON - truncated response')
+                return
+            need_more = True
+            continue
+
+        if not in_list:
+            if buf[pos] != u'[':
+                # not a list of records (e.g. an error message), decode the whole response as one document
+                while not eof:
+                    try:
+                        buf += text_decoder.decode(next(chunks))
+                    except StopIteration:
+                        eof = True
+                try:
+                    log.warn('unexpected JSON document in response - skipping data: %r', decoder.decode(buf[pos:]))
+                except simplejson.scanner.JSONDecodeError as e:
+                    log.warn('unable to decode record as JSON - %s - skipping data: %r', e, buf[pos:])
+                return
+            in_list = True
+            pos += 1
+            continue
+
+        if buf[pos] == u']':
+            return
+
+        try:
+            record, end = decoder.raw_decode(buf, pos)
+        except simplejson.scanner.JSONDecodeError as e:
+            if eof:
+                log.warn('unable to decode record as JSON - %s - skipping data: %r', e, buf[pos:])
+                return
+            need_more = True
+            continue
+
+        if end == len(buf) and not eof:
+            # the record may have been cut short at the end of the chunk
+            need_more = True
+            continue
+
+        pos = end
+        yield record
+
+
+def iter_batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def get_edex_metadata(hostname, subsite, node, sensor):
-    r = requests.get(EDEX_BASE_URL % (hostname, subsite, node, sensor) + '/metadata/parameters')
+    with timing.span('metadata_fetch'):
+        r = requests.get(EDEX_BASE_URL % (hostname, subsite, node, sensor) + '/metadata/parameters')
     try:
         r = r.json()
     except:
@@ -90,49 +370,285 @@ def get_edex_metadata(hostname, subsite, node, sensor):
     return d
 
 
-def get_from_edex(hostname, subsite, node, sensor, method, stream, start_time, stop_time, timestamp_as_string=False, netcdf=False):
+def get_edex_times(hostname, subsite, node, sensor):
+    """
+    Fetch the time range of the data stored for each stream of the sensor
+    :return: dictionary of (stream, method) -> (begin, end) NTP times
+    """
+    r = requests.get(EDEX_BASE_URL % (hostname, subsite, node, sensor) + '/metadata/times')
+    d = {}
+    try:
+        for each in r.json():
+            d[(each['stream'], each['method'])] = (string_to_ntptime(each['beginTime']),
+                                                   string_to_ntptime(each['endTime']))
+    except (ValueError, KeyError, TypeError) as e:
+        log.error('Unable to decode time metadata from edex: %s %r', e, r.content)
+
+    return d
+
+
+def get_time_windows(hostname, subsite, node, sensor, method, stream, start_time, stop_time, windows):
+    """
+    Split a retrieval into sub-windows covering the data actually stored for the stream
+    :param windows:  number of sub-windows
+    :return: list of (start, stop) NTP times
+    """
+    times = get_edex_times(hostname, subsite, node, sensor).get((stream, method))
+    if times is not None:
+        start_time = max(start_time, times[0])
+        stop_time = min(stop_time, times[1])
+
+    if stop_time < start_time:
+        # nothing stored in the requested range
+        return []
+    if stop_time == start_time:
+        return [(start_time, stop_time)]
+
+    step = (stop_time - start_time) / windows
+    bounds = [start_time + step * i for i in xrange(windows)] + [stop_time]
+    return zip(bounds[:-1], bounds[1:])
+
+
+def fetch_window(args):
+    url, start_time, stop_time = args
+    data = {'beginDT': ntptime_to_string(start_time-.1), 'endDT': ntptime_to_string(stop_time+.1)}
+    now = time.time()
+    r = get_http_session().get(url, params=data)
+    elapsed = time.time() - now
+    log.info('Took %.2f secs to retrieve data from: %s', elapsed, r.url)
+    return get_record_json(r)
+
+
+def fetch_windows(url, windows):
+    """
+    Fetch all time windows concurrently and merge the results in time order.
+    Adjacent retrieval windows overlap slightly, the records of a window also returned by the previous
+    window are dropped (once per copy, so genuinely duplicated records are kept).
+    :param url:  stream url
+    :param windows:  list of (start, stop) NTP times in time order
+    :return: list of records
+    """
+    results = get_window_pool().map(fetch_window, [(url, start, stop) for start, stop in windows])
+
+    records = []
+    previous = Counter()
+    for window_records in results:
+        overlap = previous
+        previous = Counter()
+        for record in window_records:
+            pk = record.get('pk')
+            if pk is not None:
+                key = tuple(sorted(pk.items()))
+                previous[key] += 1
+                if overlap[key]:
+                    overlap[key] -= 1
+                    continue
+            records.append(record)
+
+    records.sort(key=lambda x: x.get('pk', {}).get('time'))
+    return records
+
+
+def split_timed(records):
+    """
+    :return: (records with a valid internal_timestamp, records without)
+    """
+    timed = []
+    untimed = []
+    for record in records:
+        if isinstance(record.get('internal_timestamp'), (int, long, float)):
+            timed.append(record)
+        else:
+            untimed.append(record)
+    return timed, untimed
+
+
+def stratified_sample(records, size, rng, bins=SAMPLE_BINS):
+    """
+    Stratified random sample of expected records.  The time range is split into equal bins, each bin
+    contributes in proportion to its number of records and at least one record.  Records without a
+    valid internal_timestamp can't be retrieved by time and are not sampled (see split_timed).
+    :param size:  (approximate) number of records to sample
+    :param rng:  random.Random, seeded to reproduce a sample
+    :return: sampled records in time order
+    """
+    timed, _ = split_timed(records)
+    if size >= len(timed):
+        return sorted(timed, key=lambda x: x['internal_timestamp'])
+
+    times = numpy.array([r['internal_timestamp'] for r in timed])
+    edges = numpy.linspace(times.min(), times.max(), bins + 1)
+    strata = numpy.clip(numpy.searchsorted(edges, times, side='right') - 1, 0, bins - 1)
+
+    sample = []
+    for stratum in xrange(bins):
+        members = numpy.flatnonzero(strata == stratum).tolist()
+        if members:
+            count = max(1, int(round(size * len(members) / float(len(timed)))))
+            sample.extend(timed[i] for i in rng.sample(members, min(count, len(members))))
+
+    sample.sort(key=lambda x: x['internal_timestamp'])
+    return sample
+
+
+def sample_windows(times, margin=SAMPLE_WINDOW):
+    """
+    Merge the retrieval windows around each sampled time
+    :param times:  NTP times
+    :return: list of (start, stop) NTP times
+    """
+    windows = []
+    for t in sorted(times):
+        if windows and t - margin <= windows[-1][1]:
+            windows[-1] = (windows[-1][0], t + margin)
+        else:
+            windows.append((t - margin, t + margin))
+    return windows
+
+
+def get_sample_from_edex(hostname, subsite, node, sensor, method, stream, times, timestamp_as_string=False):
+    """
+    Retrieve only the stored sensor data around the sampled times
+    :param times:  NTP times of the sampled records
+    :return: dictionary of (stream, timestamp) -> list of edex records (array parameters as numpy arrays)
+    """
+    url = EDEX_BASE_URL % (hostname, subsite, node, sensor) + '/%s/%s' % (method, stream)
+    windows = sample_windows(times)
+
+    now = time.time()
+    with timing.span('data_fetch', windows=len(windows)):
+        records = fetch_windows(url, windows)
+    elapsed = time.time() - now
+    log.info('Took %.2f secs to retrieve %d records in %d sample windows from: %s',
+             elapsed, len(records), len(windows), url)
+
+    d = {}
+    with timing.span('json_decode', records=len(records)):
+        decode_records(records)
+        index_records(d, records, stream, timestamp_as_string)
+    return d
+
+
+def edex_results_key(hostname, subsite, node, sensor, method, stream, start_time, stop_time):
+    """
+    :return: results_cache key of a get_from_edex retrieval
+    """
+    url = EDEX_BASE_URL % (hostname, subsite, node, sensor) + '/%s/%s' % (method, stream)
+    return url, ntptime_to_string(start_time-.1), ntptime_to_string(stop_time+.1)
+
+
+def get_from_edex(hostname, subsite, node, sensor, method, stream, start_time, stop_time, timestamp_as_string=False,
+                  netcdf=False, streaming=False, windows=1):
     """
     Retrieve all stored sensor data from edex
-    :return: list of edex records
+    :param streaming:  read the response incrementally, decoding and indexing records as they arrive
+    :param windows:  split the time range into this many sub-windows and retrieve them concurrently
+    :return: dictionary of (stream, timestamp) -> list of edex records (array parameters as numpy arrays)
     """
     url = EDEX_BASE_URL % (hostname, subsite, node, sensor) + '/%s/%s' % (method, stream)
     data = {}
 
-    start_time = ntptime_to_string(start_time-.1)
-    stop_time = ntptime_to_string(stop_time+.1)
-    data['beginDT'] = start_time
-    data['endDT'] = stop_time
+    data['beginDT'] = ntptime_to_string(start_time-.1)
+    data['endDT'] = ntptime_to_string(stop_time+.1)
 
     if netcdf:
-        netcdf_file = os.path.join('%s-%s.nc' % (stream, sensor))
-        with open(netcdf_file, 'wb') as fh:
-            r = requests.get(url, params={'format': 'application/netcdf'})
-            fh.write(r.content)
-            return
+        return get_netcdf_from_edex(hostname, subsite, node, sensor, method, stream, start_time, stop_time)
+
+    results_key = edex_results_key(hostname, subsite, node, sensor, method, stream, start_time, stop_time)
+    d = {}
 
-    results_key = (url, start_time, stop_time)
+    records = results_cache.get(results_key)
+    cached = records is not None
+    if records is None and windows > 1:
+        now = time.time()
+        time_windows = get_time_windows(hostname, subsite, node, sensor, method, stream,
+                                        start_time, stop_time, windows)
+        # includes decoding the JSON of each window, done by the window threads
+        with timing.span('data_fetch', windows=len(time_windows)):
+            records = fetch_windows(url, time_windows)
+        elapsed = time.time() - now
+        log.info('Took %.2f secs to retrieve %d records in %d windows from: %s',
+                 elapsed, len(records), len(time_windows), url)
+
+    if records is None:
+        if streaming:
+            now = time.time()
+            # decoding is interleaved with the transfer, so the whole retrieval is one span
+            with timing.span('data_fetch', streaming=True):
+                r = requests.get(url, params=data, stream=True)
+                records = []
+                for batch in iter_batches(iter_record_json(r), STREAMING_BATCH_SIZE):
+                    decode_records(batch)
+                    index_records(d, batch, stream, timestamp_as_string)
+                    records.extend(batch)
+            elapsed = time.time() - now
+            log.info('Took %.2f secs to stream %d records from: %s', elapsed, len(records), r.url)
+
+            results_cache.put(results_key, records)
+            return d
 
-    if results_key not in results_cache:
         now = time.time()
-        r = requests.get(url, params=data)
+        with timing.span('data_fetch'):
+            r = requests.get(url, params=data)
         elapsed = time.time() - now
         log.info('Took %.2f secs to retrieve data from: %s', elapsed, r.url)
 
         now = time.time()
-        records = get_record_json(r)
+        with timing.span('json_decode'):
+            records = get_record_json(r)
         elapsed = time.time() - now
         log.info('Took %.2f secs to de-jsonify the data', elapsed)
 
-        results_cache[results_key] = records
-
-    records = results_cache[results_key]
-
     #log.debug('RETRIEVED:')
     #log.debug(pprint.pformat(records, depth=3))
-    d = {}
+    with timing.span('json_decode', records=len(records)):
+        decode_records(records)
+        index_records(d, records, stream, timestamp_as_string)
+
+    if not cached:
+        # cached once decoded, the cache is bounded by the size of the decoded records
+        results_cache.put(results_key, records)
+    return d
+
+
+def get_netcdf_from_edex(hostname, subsite, node, sensor, method, stream, start_time, stop_time, output_dir='.'):
+    """
+    Retrieve stored sensor data from edex as NetCDF, streaming the response to output_dir/<stream>-<sensor>.nc
+    :return: path to the NetCDF file
+    """
+    url = EDEX_BASE_URL % (hostname, subsite, node, sensor) + '/%s/%s' % (method, stream)
+    data = {'beginDT': ntptime_to_string(start_time-.1),
+            'endDT': ntptime_to_string(stop_time+.1),
+            'format': 'application/netcdf'}
+
+    netcdf_file = os.path.join(output_dir, '%s-%s.nc' % (stream, sensor))
+    now = time.time()
+    with timing.span('data_fetch', netcdf=True):
+        r = get_http_session().get(url, params=data, stream=True)
+        with open(netcdf_file, 'wb') as fh:
+            for chunk in r.iter_content(STREAMING_CHUNK_SIZE):
+                fh.write(chunk)
+    elapsed = time.time() - now
+    log.info('Took %.2f secs to retrieve NetCDF (%d bytes) from: %s', elapsed, os.path.getsize(netcdf_file), r.url)
+    return netcdf_file
+
+
+def open_netcdf(filename):
+    """
+    Open a retrieved NetCDF file, variables are only read when accessed
+    :return: xarray Dataset with raw (unmasked, undecoded) values
+    """
+    if xr is None:
+        raise ImportError('xarray is required for NetCDF validation')
+    return xr.open_dataset(filename, decode_times=False, mask_and_scale=False, decode_coords=False)
+
+
+def index_records(d, records, stream, timestamp_as_string=False):
+    """
+    Add records to the (stream, timestamp) index
+    """
     for record in records:
         timestamp = record.get('pk', {}).get('time')
-        restore_lists(record)
 
         if timestamp is not None and timestamp_as_string:
             timestamp = '%12.3f' % timestamp
@@ -140,8 +656,6 @@ def get_from_edex(hostname, subsite, node, sensor, method, stream, start_time, s
         record['timestamp'] = timestamp
         d.setdefault((stream, timestamp), []).append(record)
 
-    return d
-
 
 def nanize(l):
     rlist = []
@@ -160,16 +674,146 @@ def restore_lists(record):
             shapes.append(k)
 
     for k in shapes:
-        array_key = k.replace('_shape','')
-        shape = record[k]
-        array = numpy.array(nanize(record.get(array_key, [])))
+        restore_list(record, k)
+
+
+def restore_list(record, shape_key):
+    array_key = shape_key.replace('_shape', '')
+    shape = record[shape_key]
+    array = numpy.array(nanize(record.get(array_key, [])))
+
+    if numpy.product(shape) == len(array):
+        array = array.reshape(shape)
+    else:
+        log.error('Shape wrong? %r %d %s', shape, len(array), array)
+    record[array_key] = array.tolist()
+    del(record[shape_key])
 
-        if numpy.product(shape) == len(array):
-            array = array.reshape(shape)
-        else:
-            log.error('Shape wrong? %r %d %s', shape, len(array), array)
-        record[array_key] = array.tolist()
-        del(record[k])
+
+def record_stream(record):
+    stream_name = record.get('stream_name')
+    if stream_name is None:
+        stream_name = record.get('pk', {}).get('stream_name')
+    return stream_name
+
+
+def nanize_array(values):
+    """
+    Convert a list of (equal length) value lists to a numpy array, mapping 'NaN' strings to float NaN
+    in a single vectorized pass.  The values are held as objects while the strings are mapped, so the
+    numbers are never converted to strings (and keep their full precision).
+    :param values:  list of value lists
+    :return: numpy array or None if the values can't be held in a single array without conversion
+    """
+    try:
+        array = numpy.array(values, dtype=object)
+    except ValueError:
+        return None
+    if array.ndim != 2:
+        # ragged
+        return None
+
+    # only the (few) strings are compared with 'NaN', comparing every number with a string is slow
+    types = numpy.frompyfunc(type, 1, 1)(array)
+    strings = (types == unicode) | (types == str)
+    if not strings.any():
+        array = numpy.array(values)
+        if array.dtype.kind == 'O':
+            return None
+        return array
+
+    nans = numpy.zeros(array.shape, dtype=bool)
+    nans[strings] = array[strings] == u'NaN'
+    if not nans.any() and strings.all():
+        # genuine string data
+        return numpy.array(values)
+    if (strings & ~nans).any():
+        # numbers mixed with strings, leave them to restore_list
+        return None
+
+    array[nans] = numpy.nan
+    try:
+        return array.astype(numpy.float64)
+    except (TypeError, ValueError):
+        return None
+
+
+def decode_column(records, shape_key):
+    """
+    Build a single array holding the shape_key parameter of every record.
+    :param records:  list of edex records from a single stream
+    :param shape_key:  name of the <parameter>_shape key
+    :return: numpy array indexed by record, or None if the records can not be decoded as a block
+    """
+    array_key = shape_key.replace('_shape', '')
+    shape = records[0].get(shape_key)
+    if shape is None:
+        return None
+
+    values = []
+    for record in records:
+        value = record.get(array_key)
+        if record.get(shape_key) != shape or value is None or len(value) != numpy.product(shape):
+            return None
+        values.append(value)
+
+    array = nanize_array(values)
+    if array is None:
+        return None
+    return array.reshape([len(records)] + list(shape))
+
+
+def decode_stream(records, as_lists=False):
+    """
+    Decode the array parameters of all records from a single stream in place, building one numpy array
+    per parameter.  Each record's raw values are replaced by its row of that array (a view, no copy),
+    or by a (NaN mapped, reshaped) list if as_lists is set.
+    Array parameters which can not be decoded as a block (ragged shapes, mixed types) fall back
+    to the per-record restore_list.
+    :param records:  list of edex records from a single stream
+    :param as_lists:  if True, replace the raw values in each record with lists, as restore_lists does
+    :return: dictionary of parameter name -> numpy array indexed by record
+    """
+    columns = {}
+    keys = set()
+    for record in records:
+        keys.update(record)
+
+    for k in keys:
+        if not k.endswith('_shape'):
+            continue
+
+        array_key = k.replace('_shape', '')
+        array = decode_column(records, k)
+
+        if array is None:
+            for record in records:
+                if k in record:
+                    restore_list(record, k)
+            continue
+
+        columns[array_key] = array
+        for i, record in enumerate(records):
+            del(record[k])
+            record[array_key] = array[i].tolist() if as_lists else array[i]
+
+    return columns
+
+
+def decode_records(records, as_lists=False):
+    """
+    Batch decode the records of a get_from_edex response in place (the equivalent of restore_lists
+    on every record), see decode_stream.
+    :param records:  list of edex records
+    :param as_lists:  if True, the array parameters of the records are lists rather than numpy arrays
+    :return: dictionary of stream name -> dictionary of parameter name -> numpy array
+    """
+    streams = {}
+    for record in records:
+        streams.setdefault(record_stream(record), []).append(record)
+
+    return dict((stream, decode_stream(stream_records, as_lists=as_lists))
+                for stream, stream_records in streams.iteritems())
 
 
 # noinspection PyClassHasNoInit
@@ -195,53 +839,77 @@ def find_latest_log():
     return fh
 
 
+def get_log_tailer(logfile=None, directory=None):
+    """
+    Fetch the shared tailer of an EDEX log directory, starting it if necessary.
+    :param logfile:  open log file for a new tailer to continue from (see find_latest_log)
+    :param directory:  EDEX log directory, defaults to the local EDEX logs
+    :return:  LogTailer
+    """
+    directory = directory or log_dir
+    with log_tailer_lock:
+        if directory not in log_tailers:
+            log_tailers[directory] = LogTailer(directory, logfile=logfile)
+            log_tailers[directory].start()
+        return log_tailers[directory]
+
+
 def watch_log_for(expected_string, logfile=None, expected_count=1, timeout=DEFAULT_STANDARD_TIMEOUT):
     """
     Wait for expected string to appear in log file.
+    Only lines logged after this call (or after the shared tailer was started) are seen, callers which
+    trigger the logged event should subscribe to get_log_tailer() before doing so.
     :param expected_string:   string to watch for in log file
     :param logfile:   file to watch
     :param expected_count:  number of occurrences expected
     :param timeout:  maximum time to wait for expected string
     :return:  True if expected string occurs before specified timeout, False otherwise.
     """
-    if logfile is None:
-        try:
-            logfile = find_latest_log()
-        except OSError as e:
-            log.error('Error fetching latest log file - %s', e)
-            return False
+    tailer = get_log_tailer(logfile)
 
-    log.info('waiting for %s in logfile: %s', expected_string, logfile.name)
+    log.info('waiting for %s in logfile: %s', expected_string, tailer.path)
     log.info('timeout value: %s', timeout)
 
-    end_time = time.time() + timeout
-    count = 0
-
+    watcher = tailer.subscribe(expected_string, expected_count=expected_count)
     try:
-        while time.time() < end_time:
-            data = logfile.read()
-            for line in data.split('\n'):
-                if expected_string in line:
-                    count += 1
-                    log.info('Found expected string %d times of %d', count, expected_count)
-                    if count == expected_count:
-                        return True
-            time.sleep(.1)
-    except KeyboardInterrupt:
-        pass
-    return False
+        return watcher.wait(timeout)
+    finally:
+        tailer.unsubscribe(watcher)
+
+
+def format_pass_rate(pass_count, count, population=None):
+    """
+    :param population:  number of records the count was sampled from, None if not sampled
+    :return: pass rate, with the 95% confidence interval when sampled
+    """
+    if count == 0:
+        return 'n/a'
+    rate = '%.1f%%' % (100.0 * pass_count / count)
+    if population is None or count >= population:
+        return rate
+    low, high = wilson_interval(pass_count, count)
+    return '%s (%.1f-%.1f%%)' % (rate, 100 * low, 100 * high)
 
 
 def parse_scorecard(scorecard):
+    """
+    :param scorecard:  instrument -> input file -> yaml file -> stream -> results, where results are
+                       (edex_count, yaml_count, failures[, population]), failures is the list of failures
+                       or their number and population is the number of expected records a sampled run
+                       chose the yaml_count records from
+    :return: (report, table data)
+    """
     result = ['SCORECARD:']
-    format_string = "{: <%d}   {: <%d}   {: <%d}   {: <%d} {: >15} {: >15} {: >15} {: >15}"
+    format_string = "{: <%d}   {: <%d}   {: <%d}   {: <%d} {: >15} {: >15} {: >15} {: >15} {: >24}"
 
     total_instrument_count = 0
     total_yaml_count = 0
     total_edex_count = 0
     total_pass_count = 0
     total_fail_count = 0
-    table_data = [['Instrument', 'Input File', 'Output File', 'Stream', 'YAML_count', 'EDEX_count', 'Pass', 'Fail']]
+    sampled = False
+    table_data = [['Instrument', 'Input File', 'Output File', 'Stream', 'YAML_count', 'EDEX_count', 'Pass', 'Fail',
+                   'Pass Rate']]
 
     longest = {}
     last_label = {}
@@ -252,8 +920,14 @@ def parse_scorecard(scorecard):
                 for stream in sorted(scorecard[instrument][test_file][yaml_file].keys()):
                     results = scorecard[instrument][test_file][yaml_file][stream]
 
-                    edex_count, yaml_count, fail_count = results
-                    pass_count = yaml_count - len(fail_count)
+                    edex_count, yaml_count, fail_count = results[:3]
+                    population = results[3] if len(results) > 3 else None
+                    # failures may already have been reduced to their number
+                    if not isinstance(fail_count, (int, long)):
+                        fail_count = len(fail_count)
+                    pass_count = yaml_count - fail_count
+                    if population is not None and population > yaml_count:
+                        sampled = True
 
                     labels = {}
 
@@ -273,12 +947,13 @@ def parse_scorecard(scorecard):
                                        yaml_count,
                                        edex_count,
                                        pass_count,
-                                       len(fail_count)])
+                                       fail_count,
+                                       format_pass_rate(pass_count, yaml_count, population)])
 
                     total_yaml_count += yaml_count
                     total_edex_count += edex_count
                     total_pass_count += pass_count
-                    total_fail_count += len(fail_count)
+                    total_fail_count += fail_count
                     total_instrument_count += 1
 
     format_string = format_string % (
@@ -297,14 +972,57 @@ def parse_scorecard(scorecard):
 
     result.append('')
     result.append('-' * (len(banner)+12))
-    row = ['Total Instrument', '', '', '', 'Total YAML', 'Total EDEX', 'Total Pass', 'Total Fail']
+    row = ['Total Instrument', '', '', '', 'Total YAML', 'Total EDEX', 'Total Pass', 'Total Fail', 'Total Pass Rate']
     result.append(format_string.format(*row))
 
-    row = [total_instrument_count, '', '', '', total_yaml_count, total_edex_count, total_pass_count, total_fail_count]
+    # the sampled streams are of different sizes, so no interval is given for the total
+    total_rate = format_pass_rate(total_pass_count, total_yaml_count)
+    if sampled:
+        total_rate += ' (sampled)'
+    row = [total_instrument_count, '', '', '', total_yaml_count, total_edex_count, total_pass_count, total_fail_count,
+           total_rate]
     result.append(format_string.format(*row))
     return '\n'.join(result), table_data
 
 
+def iter_edex_records(hostname, stream, instrument, sample_data_file=None):
+    """
+    Stream all stored records of one stream of an instrument from edex, without holding them in memory.
+    :param stream:      stream name
+    :param instrument:  reference designator (subsite-node-sensor)
+    :param sample_data_file:  if supplied, the records are also saved here as a JSON list
+    :return:            generator of JSON records
+    """
+    subsite, node, sensor = instrument.split('-', 2)
+    times = get_edex_times(hostname, subsite, node, sensor)
+    session = get_http_session()
+
+    out = None
+    if sample_data_file is not None:
+        out = open(sample_data_file, 'wb')
+        out.write('[')
+    first = True
+    try:
+        for (time_stream, method), (start_time, stop_time) in sorted(times.iteritems()):
+            if time_stream != stream:
+                continue
+            url = EDEX_BASE_URL % (hostname, subsite, node, sensor) + '/%s/%s' % (method, stream)
+            params = {'beginDT': ntptime_to_string(start_time - .1), 'endDT': ntptime_to_string(stop_time + .1)}
+            with timing.span('data_fetch', streaming=True):
+                r = session.get(url, params=params, stream=True)
+                for record in iter_record_json(r):
+                    if out is not None:
+                        if not first:
+                            out.write(',\n')
+                        simplejson.dump(record, out)
+                        first = False
+                    yield record
+    finally:
+        if out is not None:
+            out.write(']\n')
+            out.close()
+
+
 def edex_mio_report(hostname, stream, instrument, output_dir='.'):
     """
     Calculate statistics for captured data stream and write to CSV file output_dir/<stream>-<instrument>.csv.
@@ -317,43 +1035,36 @@ def edex_mio_report(hostname, stream, instrument, output_dir='.'):
     stat_file = os.path.join(output_dir, '%s-%s.csv' % (stream, instrument))
     json_file = os.path.join(output_dir, '%s-%s.json' % (stream, instrument))
 
-    data = edex_get_json(hostname, stream, instrument, sample_data_file=json_file, save_sample_data=True)
-    d = {}
+    records = iter_edex_records(hostname, stream, instrument, sample_data_file=json_file)
+    stats = {}
+    skipped = set()
+
+    # single pass over the streamed data, chunk by chunk
+    for chunk in iter_batches(records, MIO_CHUNK_SIZE):
+        d = {}
+        for record in chunk:
+            for param in record:
+                d.setdefault(param, []).append(record[param])
 
-    # first pass to extract data values
-    for record in data:
-        for param in record:
-            d.setdefault(param, []).append(record[param])
+        for param, values in d.iteritems():
+            if param in skipped:
+                continue
+            value = numpy.array(values)
+            if value.dtype.kind in 'iuf':
+                stats.setdefault(param, ParameterStats()).update(value)
+            else:
+                skipped.add(param)
+                stats.pop(param, None)
+                log.info(" - skipping non-numeric data for %s", param)
 
-    # second pass to compute statistics
     log.info('saving statistics to %s', stat_file)
     with open(stat_file, 'wb') as f:
         f.write("key,count,min,max,median,mean,sigma\n")
-        for param in sorted(d.keys()):
-            value = numpy.array(d[param])
-            dtype = value.dtype
-            if dtype.kind in 'iuf':
-                # expect 1 or 2-d arrays - other multi-dimensional arrays are not supported
-                if len(value.shape) > 1:
-                    value = numpy.transpose(value)
-                    for i, row in enumerate(value):
-                        v_min = numpy.min(row)
-                        v_max = numpy.max(row)
-                        median = numpy.median(row)
-                        mean = numpy.mean(row)
-                        sigma = numpy.std(row)
-                        f.write("%s(%d),%d,%f,%f,%f,%f,%f\n" % (param, i, len(row), v_min, v_max, median, mean, sigma))
-
-                v_min = numpy.min(value)
-                v_max = numpy.max(value)
-                median = numpy.median(value)
-                mean = numpy.mean(value)
-                sigma = numpy.std(value)
-                f.write("%s,%d,%f,%f,%f,%f,%f\n" % (param, len(value), v_min, v_max, median, mean, sigma))
-            else:
-                s = set()
-                s.update(list(value.flatten()))
-                log.info(" - skipping non-numeric data for %s", param)
+        for param in sorted(stats.keys()):
+            # expect 1 or 2-d arrays - higher dimensions are flattened to columns
+            for i, row in enumerate(stats[param].column_rows()):
+                f.write("%s(%d),%d,%f,%f,%f,%f,%f\n" % ((param, i) + row))
+            f.write("%s,%d,%f,%f,%f,%f,%f\n" % ((param,) + stats[param].row()))
 
 
 def check_for_sign_error(a, b):
@@ -377,9 +1088,64 @@ def check_for_sign_error(a, b):
         return True
 
 
+def numeric_array(value):
+    """
+    :return: value as a numpy array if it is a homogeneous numeric list (or array), otherwise None
+    """
+    try:
+        array = numpy.asarray(value)
+    except ValueError:
+        return None
+    if array.dtype.kind not in 'iuf':
+        return None
+    return array
+
+
+def same_array(a, b, errors, float_tolerance=0.001):
+    """
+    Compare two numeric arrays in a single vectorized pass, NaN matches NaN.
+    Only the first MAX_REPORTED_DIFFERENCES differing elements are reported.
+    :return: True/False, or None if either value is not a numeric array of matching shape
+    """
+    a_array = numeric_array(a)
+    if a_array is None:
+        return None
+    b_array = numeric_array(b)
+    if b_array is None or a_array.shape != b_array.shape:
+        return None
+
+    if a_array.dtype.kind in 'iu' and b_array.dtype.kind in 'iu':
+        matches = a_array == b_array
+    else:
+        with numpy.errstate(invalid='ignore'):
+            matches = (a_array == b_array) | (numpy.abs(a_array - b_array) < float_tolerance) | \
+                      (numpy.isnan(a_array) & numpy.isnan(b_array))
+
+    if matches.all():
+        return True
+
+    differences = numpy.argwhere(~matches)
+    reported = []
+    for index in differences[:MAX_REPORTED_DIFFERENCES]:
+        index = tuple(index)
+        reported.append('%s: %r %r' % (','.join(str(i) for i in index), a_array[index], b_array[index]))
+    errors.append('FAILED arrays: %d of %d values differ, first at [%s]' %
+                  (len(differences), matches.size, '; '.join(reported)))
+    return False
+
+
 def same(a, b, errors, float_tolerance=0.001):
     string_types = [str, unicode]
     # log.info('same(%r,%r) %s %s', a, b, type(a), type(b))
+    if isinstance(a, numpy.ndarray) or isinstance(b, numpy.ndarray):
+        result = same_array(a, b, errors, float_tolerance=float_tolerance)
+        if result is not None:
+            return result
+        if isinstance(a, numpy.ndarray):
+            a = a.tolist()
+        if isinstance(b, numpy.ndarray):
+            b = b.tolist()
+
     if a == b:
         return True
 
@@ -395,6 +1161,9 @@ def same(a, b, errors, float_tolerance=0.001):
     if type(a) is list:
         if len(a) != len(b):
             return False
+        result = same_array(a, b, errors, float_tolerance=float_tolerance)
+        if result is not None:
+            return result
         return all([same(a[i], b[i], errors, float_tolerance=float_tolerance) for i in xrange(len(a))])
 
     if type(a) is float or type(b) is float:
@@ -419,56 +1188,123 @@ def same(a, b, errors, float_tolerance=0.001):
 
     if type(a) is int and type(b) is int:
         if check_for_sign_error(a, b):
-            errors.append('Detected unsigned/signed issue: %r, %r' % a, b)
+            errors.append('Detected unsigned/signed issue: %r, %r' % (a, b))
 
     return False
 
 
-def compare(stored, expected, metadata, ignore_nulls=False, lookup_preferred_timestamp=False):
+def to_millis(t):
+    return int(round(t * 1000))
+
+
+def match_timestamps(expected_ms, stored_ms, tolerance=DEFAULT_TIME_TOLERANCE_MS):
+    """
+    Join expected timestamps against sorted retrieved timestamps.
+    :param expected_ms:  numpy array of expected timestamps (integer milliseconds)
+    :param stored_ms:  sorted numpy array of retrieved timestamps (integer milliseconds)
+    :param tolerance:  maximum difference in milliseconds for two timestamps to match
+    :return: arrays of (start, stop) index ranges into stored_ms holding the candidates for each expected timestamp
+    """
+    start = numpy.searchsorted(stored_ms, expected_ms - tolerance, side='left')
+    stop = numpy.searchsorted(stored_ms, expected_ms + tolerance, side='right')
+    return start, stop
+
+
+def compare(stored, expected, metadata, ignore_nulls=False, lookup_preferred_timestamp=False,
+            time_tolerance=DEFAULT_TIME_TOLERANCE_MS):
     """
     Compares a set of expected results against the retrieved values
-    :param stored:
-    :param expected:
+    :param stored:  retrieved records, as returned by get_from_edex
+    :param expected:  list of expected records
+    :param time_tolerance:  maximum difference (ms) between matching timestamps
     :return: list of failures
     """
     failures = []
-    for record in expected:
+    plans = {}
+
+    # retrieved records for each stream, sorted by time in integer milliseconds
+    stored_records = {}
+    for (stream_name, _), records in stored.iteritems():
+        for each in records:
+            timestamp = each.get('pk', {}).get('time')
+            if timestamp is not None:
+                stored_name = record_stream(each) or stream_name
+                stored_records.setdefault(stored_name, []).append((to_millis(timestamp), each))
+
+    stored_times = {}
+    for stream_name, records in stored_records.iteritems():
+        records.sort(key=lambda x: x[0])
+        stored_times[stream_name] = numpy.array([x[0] for x in records], dtype=numpy.int64)
+
+    # expected record timestamps, grouped by stream
+    expected_streams = []
+    expected_times = []
+    by_stream = {}
+    for index, record in enumerate(expected):
         if lookup_preferred_timestamp:
-            timestamp = '%12.3f' % record.get(record.get('preferred_timestamp'), 0.0)
+            timestamp = record.get(record.get('preferred_timestamp'), 0.0)
         else:
-            timestamp = '%12.3f' % record.get('internal_timestamp', 0.0)
+            timestamp = record.get('internal_timestamp', 0.0)
+        try:
+            timestamp = to_millis(timestamp)
+        except (TypeError, ValueError):
+            timestamp = None
+
         stream_name = record.get('particle_type') or record.get('stream_name')
         # Not all YAML files contain the particle type
         # if we don't find it, let's check the stored data
         # if all particles are the same type, then we'll proceed
         if stream_name is None:
             log.warn('Missing stream name from YML file, attempting to infer')
-            keys = stored.keys()
-            keys = [x[1] for x in keys]
-            keys = set(keys)
-            if len(keys) == 1:
-                key = (timestamp, keys.pop())
+            if len(stored_records) == 1:
+                stream_name = stored_records.keys()[0]
             else:
-                failures.append((FAILURES.AMBIGUOUS, 'Multiple streams in output, no stream in YML'))
-                log.error('Ambiguous stream information in YML file and unable to infer')
-                continue
+                stream_name = None
+
+        expected_streams.append(stream_name)
+        expected_times.append(timestamp)
+        if stream_name is not None and timestamp is not None:
+            by_stream.setdefault(stream_name, []).append(index)
+
+    candidates = {}
+    for stream_name, indices in by_stream.iteritems():
+        times = stored_times.get(stream_name)
+        if times is None:
+            continue
+        start, stop = match_timestamps(numpy.array([expected_times[i] for i in indices], dtype=numpy.int64),
+                                       times, time_tolerance)
+        for i, index in enumerate(indices):
+            candidates[index] = (start[i], stop[i])
+
+    for index, record in enumerate(expected):
+        stream_name = expected_streams[index]
+        timestamp = expected_times[index]
+        if stream_name is None:
+            failures.append((FAILURES.AMBIGUOUS, 'Multiple streams in output, no stream in YML'))
+            log.error('Ambiguous stream information in YML file and unable to infer')
+            continue
+
+        plan = plans.get(stream_name)
+        if plan is None:
+            plan = plans[stream_name] = ComparisonPlan(stream_name, metadata, ignore_nulls=ignore_nulls)
 
         matches = []
-        for each in stored.get((stream_name, timestamp), []):
-            stored_name = each.get('stream_name')
-            if stored_name is None:
-                stored_name = each.get('pk', {}).get('stream_name')
-            if stored_name == stream_name and each['timestamp'] == timestamp:
-                f, errors = diff(stream_name, record, each, metadata, ignore_nulls=ignore_nulls)
-                matches.append((len(f), each, f, errors))
-
-        matches.sort()
+        start, stop = candidates.get(index, (0, 0))
+        for position in xrange(start, stop):
+            stored_time, each = stored_records[stream_name][position]
+            f, errors = plan.diff(record, each)
+            matches.append((len(f), abs(stored_time - timestamp), position, f, errors))
+
+        matches.sort(key=lambda x: x[:3])
         if len(matches) == 0:
-            m = 'Unable to find a matching sample: %s %s' % (stream_name, timestamp)
+            if timestamp is None:
+                m = 'Unable to find a matching sample: %s (invalid timestamp)' % stream_name
+            else:
+                m = 'Unable to find a matching sample: %s %12.3f' % (stream_name, timestamp / 1000.0)
             failures.append((FAILURES.MISSING_SAMPLE, m))
             log.error(m)
         if len(matches) > 0:
-            failcount, match, f, errors = matches[0]
+            failcount, _, _, f, errors = matches[0]
             if failcount > 0:
                 # we had at least one failure, but this record
                 # was the closest match; record the failures
@@ -479,6 +1315,148 @@ def compare(stored, expected, metadata, ignore_nulls=False, lookup_preferred_tim
     return failures
 
 
+def column_matches(values, retrieved, float_tolerance=0.001):
+    """
+    Compare a column of expected values against the retrieved variable values, row by row.
+    :param values:  list of expected values, one per row
+    :param retrieved:  numpy array of retrieved values, one per row
+    :return: boolean numpy array (one entry per row) or None if the column is not numeric
+    """
+    expected = numeric_array(values)
+    if expected is None or retrieved.dtype.kind not in 'iuf' or expected.shape != retrieved.shape:
+        return None
+
+    if expected.dtype.kind in 'iu' and retrieved.dtype.kind in 'iu':
+        matches = expected == retrieved
+    else:
+        with numpy.errstate(invalid='ignore'):
+            matches = (expected == retrieved) | (numpy.abs(expected - retrieved) < float_tolerance) | \
+                      (numpy.isnan(expected) & numpy.isnan(retrieved))
+
+    if matches.ndim > 1:
+        matches = matches.reshape(len(matches), -1).all(axis=1)
+    return matches
+
+
+def compare_columnar(ds, expected, metadata, ignore_nulls=False, lookup_preferred_timestamp=False,
+                     time_tolerance=DEFAULT_TIME_TOLERANCE_MS, float_tolerance=0.001):
+    """
+    Compares a set of expected results against a retrieved NetCDF dataset, one variable at a time
+    :param ds:  dataset holding a single stream (see open_netcdf)
+    :param expected:  list of expected records
+    :param metadata:  parameter metadata (see get_edex_metadata)
+    :return: list of failures, in the same form as compare
+    """
+    stream_name = ds.attrs.get('stream')
+    plan = ComparisonPlan(stream_name, metadata, ignore_nulls=ignore_nulls, float_tolerance=float_tolerance)
+    failures = {}
+
+    # match each expected record to the nearest retrieved observation
+    if 'time' in ds.variables and ds['time'].size:
+        stored_ms = numpy.round(ds['time'].values * 1000).astype(numpy.int64)
+    else:
+        stored_ms = numpy.array([], dtype=numpy.int64)
+    order = numpy.argsort(stored_ms, kind='mergesort')
+    sorted_ms = stored_ms[order]
+
+    expected_ms = numpy.zeros(len(expected), dtype=numpy.int64)
+    valid = numpy.zeros(len(expected), dtype=bool)
+    for index, record in enumerate(expected):
+        if lookup_preferred_timestamp:
+            timestamp = record.get(record.get('preferred_timestamp'), 0.0)
+        else:
+            timestamp = record.get('internal_timestamp', 0.0)
+        try:
+            expected_ms[index] = to_millis(timestamp)
+            valid[index] = True
+        except (TypeError, ValueError):
+            pass
+
+    matched = numpy.repeat(-1, len(expected))
+    if len(sorted_ms):
+        position = numpy.searchsorted(sorted_ms, expected_ms)
+        left = numpy.clip(position - 1, 0, len(sorted_ms) - 1)
+        right = numpy.clip(position, 0, len(sorted_ms) - 1)
+        use_left = numpy.abs(sorted_ms[left] - expected_ms) <= numpy.abs(sorted_ms[right] - expected_ms)
+        nearest = numpy.where(use_left, left, right)
+        found = valid & (numpy.abs(sorted_ms[nearest] - expected_ms) <= time_tolerance)
+        matched = numpy.where(found, order[nearest], -1)
+
+    rows = numpy.flatnonzero(matched >= 0)
+    for index in numpy.flatnonzero(matched < 0):
+        m = 'Unable to find a matching sample: %s %12.3f' % (stream_name, expected_ms[index] / 1000.0)
+        failures[index] = (FAILURES.MISSING_SAMPLE, m)
+
+    # rows holding each expected key
+    key_rows = {}
+    for index in rows:
+        for k in expected[index]:
+            key_rows.setdefault(k, []).append(index)
+
+    compared = set()
+    for k, indices in key_rows.iteritems():
+        target = plan.key(k)
+        if target is None:
+            continue
+        compared.add(target)
+
+        attribute = NETCDF_ATTRIBUTES.get(target, target)
+        if target not in ds.variables and attribute not in ds.attrs:
+            message = '%s - missing key: %s in retrieved record' % (stream_name, target)
+            for index in indices:
+                if ignore_nulls and expected[index][k] is None:
+                    continue
+                failures.setdefault(index, []).append((FAILURES.MISSING_FIELD, message))
+            continue
+
+        values = []
+        for index in indices:
+            v = expected[index][k]
+            if type(v) == dict:
+                v = v.get('value')
+            values.append(v)
+
+        if target not in ds.variables:
+            retrieved = numpy.array([ds.attrs[attribute]] * len(indices))
+        elif ds[target].dims[:1] == ('obs',):
+            retrieved = ds[target].values[matched[indices]]
+        else:
+            retrieved = numpy.array([ds[target].values] * len(indices))
+
+        matches = column_matches(values, retrieved, float_tolerance=float_tolerance)
+        if matches is None:
+            matches = [same(v, r.tolist(), [], float_tolerance=float_tolerance) for v, r in zip(values, retrieved)]
+
+        for i in numpy.flatnonzero(numpy.logical_not(matches)):
+            v = values[i]
+            r = retrieved[i].tolist()
+            if plan.is_fill(target, r):
+                log.info('%s - Found fill value: key=%r expected=%r retrieved=%r' % (stream_name, target, v, r))
+            else:
+                message = '%s - non-matching value: key=%r expected=%r retrieved=%r' % (stream_name, target, v, r)
+                failures.setdefault(indices[i], []).append((FAILURES.BAD_VALUE, message))
+
+    # verify no extra (unexpected) stream parameters are present in the retrieved data
+    for k in metadata:
+        if k in compared or k in plan.ignore or k not in ds.variables or ds[k].dims[:1] != ('obs',):
+            continue
+        retrieved = ds[k].values[matched[rows]]
+        for i, index in enumerate(rows):
+            if not plan.is_fill(k, retrieved[i].tolist()):
+                failures.setdefault(index, []).append((FAILURES.UNEXPECTED_VALUE, (stream_name, k)))
+
+    result = []
+    for index in sorted(failures):
+        f = failures[index]
+        result.append(f)
+        if type(f) is tuple:
+            log.error(f[1])
+        else:
+            for failure in f:
+                log.error(failure[1])
+    return result
+
+
 def check_fill(a, b):
     if type(a) == int:
         try:
@@ -496,6 +1474,161 @@ def check_fill(a, b):
 
     return a == b
 
+DEFAULT_IGNORE = ['particle_object', 'quality_flag', 'driver_timestamp', 'ingestion_timestamp',
+                  'stream_name', 'preferred_timestamp', 'port_timestamp', 'pk', 'timestamp', 'provenance']
+DEFAULT_RENAME = {'particle_type': 'stream_name'}
+
+
+def same_number(a, b, errors, float_tolerance=0.001):
+    """
+    Fast path of same() for scalar numeric fields, falls back to same() for anything else
+    """
+    if a == b:
+        return True
+    if type(a) is float and type(b) is float:
+        if abs(a-b) < float_tolerance or (a != a and b != b):
+            return True
+        errors.append('FAILED floats: %r %r' % (a, b))
+        return False
+    return same(a, b, errors, float_tolerance=float_tolerance)
+
+
+class ComparisonPlan(object):
+    """
+    Comparison rules for the records of one stream (ignored keys, renames, fill values and per field
+    comparators), compiled once and applied to every record.
+    """
+    def __init__(self, stream, metadata, ignore=None, rename=None, ignore_nulls=False, float_tolerance=0.001):
+        """
+        :param stream:  stream name
+        :param metadata:  parameter metadata (see get_edex_metadata)
+        :param ignore: fields to ignore
+        :param rename: fields to rename before comparison
+        """
+        if ignore is None:
+            ignore = DEFAULT_IGNORE
+        if rename is None:
+            rename = DEFAULT_RENAME
+
+        self.stream = stream
+        self.ignore = frozenset(ignore)
+        self.rename = dict(rename)
+        self.ignore_nulls = ignore_nulls
+        self.float_tolerance = float_tolerance
+
+        # fill values converted to the types they may be compared against
+        self.fills = {}
+        for k, m in metadata.iteritems():
+            fill = m.get('fillValue')
+            if fill is not None:
+                self.fills[k] = (fill, self._convert(int, fill), self._convert(float, fill))
+
+        # expected key -> retrieved key (None when ignored), filled in as keys are seen
+        self.keys = {}
+        self.comparators = {}
+
+    @staticmethod
+    def _convert(kind, value):
+        try:
+            return kind(value)
+        except (TypeError, ValueError):
+            return None
+
+    def is_fill(self, k, value):
+        """
+        Equivalent of check_fill(value, metadata[k]['fillValue'])
+        """
+        fill = self.fills.get(k)
+        if fill is None:
+            return False
+        if isinstance(value, numpy.ndarray):
+            value = value.tolist()
+        raw, as_int, as_float = fill
+        if type(value) == int:
+            return as_int is not None and value == as_int
+        if type(value) == float:
+            return as_float is not None and value == as_float
+        return value == raw
+
+    def key(self, k):
+        """
+        :return: retrieved key to compare the expected key k against, None if k is ignored
+        """
+        if k in self.keys:
+            return self.keys[k]
+        return self._key(k)
+
+    def _key(self, k):
+        if k in self.ignore or k.startswith('_'):
+            target = None
+        else:
+            target = self.rename.get(k, k)
+        self.keys[k] = target
+        return target
+
+    def _comparator(self, k, v):
+        if type(v) in (int, float):
+            comparator = same_number
+        else:
+            comparator = same
+        self.comparators[k] = comparator
+        return comparator
+
+    def diff(self, a, b):
+        """
+        Compare two data records
+        :param a:  expected record
+        :param b:  retrieved record
+        :return: list of failures, list of error messages
+        """
+        stream = self.stream
+        keys = self.keys
+        comparators = self.comparators
+        failures = []
+        errors = []
+
+        # verify from expected to retrieved
+        for k, v in a.iteritems():
+            target = keys[k] if k in keys else self._key(k)
+            if target is None:
+                continue
+            k = target
+            if k not in b:
+                message = '%s - missing key: %s in retrieved record' % (stream, k)
+                errors.append(message)
+                if self.ignore_nulls and v is None:
+                    log.info('Ignoring NULL value from expected data')
+                else:
+                    failures.append((FAILURES.MISSING_FIELD, message))
+                continue
+
+            if type(v) == dict:
+                v = v.get('value')
+
+            comparator = comparators.get(k) or self._comparator(k, v)
+            if not comparator(v, b[k], errors, float_tolerance=self.float_tolerance):
+                retrieved = b[k]
+                if isinstance(retrieved, numpy.ndarray):
+                    retrieved = retrieved.tolist()
+                if self.is_fill(k, retrieved):
+                    log.info('%s - Found fill value: key=%r expected=%r retrieved=%r' % (stream, k, v, retrieved))
+                else:
+                    message = '%s - non-matching value: key=%r expected=%r retrieved=%r' % (stream, k, v, retrieved)
+                    failures.append((FAILURES.BAD_VALUE,
+                                     message))
+                    errors.append(message)
+
+        # verify no extra (unexpected) keys present in retrieved data
+        for k in b:
+            if k not in a and k not in self.ignore:
+                if not self.is_fill(k, b[k]):
+                    failures.append((FAILURES.UNEXPECTED_VALUE, (stream, k)))
+                    message = '%s - item in retrieved data not in expected data: %s' % (stream, k)
+                    errors.append(message)
+
+        return failures, errors
+
+
 def diff(stream, a, b, metadata, ignore=None, rename=None, ignore_nulls=False, float_tolerance=0.001):
     """
     Compare two data records
@@ -505,52 +1638,6 @@ def diff(stream, a, b, metadata, ignore=None, rename=None, ignore_nulls=False, f
     :param rename: fields to rename before comparison
     :return: list of failures
     """
-    if ignore is None:
-        ignore = ['particle_object', 'quality_flag', 'driver_timestamp', 'ingestion_timestamp',
-                  'stream_name', 'preferred_timestamp', 'port_timestamp', 'pk', 'timestamp', 'provenance']
-    if rename is None:
-        rename = {'particle_type': 'stream_name'}
-
-    failures = []
-    errors = []
-
-    # verify from expected to retrieved
-    for k, v in a.iteritems():
-        if k in ignore or k.startswith('_'):
-            continue
-        if k in rename:
-            k = rename[k]
-        if k not in b:
-            message = '%s - missing key: %s in retrieved record' % (stream, k)
-            errors.append(message)
-            if ignore_nulls and v is None:
-                log.info('Ignoring NULL value from expected data')
-            else:
-                failures.append((FAILURES.MISSING_FIELD, message))
-            continue
-
-        if type(v) == dict:
-            v = v.get('value')
-
-        if not same(v, b[k], errors, float_tolerance=float_tolerance):
-            # check if fill value
-            fill = metadata.get(k, {}).get('fillValue')
-            if fill is not None and check_fill(b[k], fill):
-                log.info('%s - Found fill value: key=%r expected=%r retrieved=%r' % (stream, k, v, b[k]))
-            else:
-                message = '%s - non-matching value: key=%r expected=%r retrieved=%r' % (stream, k, v, b[k])
-                failures.append((FAILURES.BAD_VALUE,
-                                 message))
-                errors.append(message)
-
-    # verify no extra (unexpected) keys present in retrieved data
-    for k in b:
-        if k not in a and k not in ignore:
-            # check if fill value
-            fill = metadata.get(k, {}).get('fillValue')
-            if fill is None or not check_fill(b[k], fill):
-                failures.append((FAILURES.UNEXPECTED_VALUE, (stream, k)))
-                message = '%s - item in retrieved data not in expected data: %s' % (stream, k)
-                errors.append(message)
-
-    return failures, errors
+    plan = ComparisonPlan(stream, metadata, ignore=ignore, rename=rename, ignore_nulls=ignore_nulls,
+                          float_tolerance=float_tolerance)
+    return plan.diff(a, b)
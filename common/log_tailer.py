@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+import glob
+import os
+import threading
+import time
+
+from logger import get_logger
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+log = get_logger()
+
+LOG_GLOB = 'edex-ooi-*.log*'
+# rotated logs which are never written to again
+ARCHIVE_SUFFIXES = ('.gz', '.bz2', '.xz', '.zip', 'lck')
+POLL_INTERVAL = .1
+ROTATION_CHECK_INTERVAL = 1
+
+
+def find_active_log(log_dir):
+    """
+    Find the most recently modified EDEX log file, preferring live (*.log) files to rotated ones
+    and ignoring compressed archives.
+    :param log_dir:  EDEX log directory
+    :return:  path to the log file or None if not found
+    """
+    files = []
+    for f in glob.glob(os.path.join(log_dir, LOG_GLOB)):
+        if f.endswith(ARCHIVE_SUFFIXES):
+            continue
+        try:
+            files.append((f.endswith('.log'), os.stat(f).st_mtime, f))
+        except OSError:
+            # rotated away
+            pass
+    if not files:
+        return None
+    return max(files)[2]
+
+
+class LogWatcher(object):
+    """
+    Subscriber counting the log lines which contain expected_string.
+    """
+    def __init__(self, expected_string, expected_count=1, callback=None):
+        """
+        :param expected_string:  string to watch for in the log
+        :param expected_count:  number of occurrences expected (None to count without completing)
+        :param callback:  function called with each matching line
+        """
+        self.expected_string = expected_string
+        self.expected_count = expected_count
+        self.callback = callback
+        self.count = 0
+        self.event = threading.Event()
+
+    def feed(self, line):
+        if self.expected_string not in line:
+            return
+
+        self.count += 1
+        if self.expected_count:
+            log.info('Found expected string %d times of %d', self.count, self.expected_count)
+        if self.callback is not None:
+            self.callback(line)
+        self._check()
+
+    def set_expected_count(self, expected_count):
+        self.expected_count = expected_count
+        self._check()
+
+    def wait(self, timeout):
+        """
+        Wait for the expected number of occurrences
+        :param timeout:  maximum time to wait
+        :return:  True if the expected count was reached before the timeout, False otherwise.
+        """
+        end_time = time.time() + timeout
+        try:
+            while not self.event.is_set():
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    return False
+                # short waits keep the main thread responsive to KeyboardInterrupt
+                self.event.wait(min(remaining, 1))
+        except KeyboardInterrupt:
+            return False
+        return True
+
+    def _check(self):
+        if self.expected_count is not None and self.count >= self.expected_count:
+            self.event.set()
+
+
+if pyinotify is not None:
+    class _Wakeup(pyinotify.ProcessEvent):
+        def process_default(self, event):
+            pass
+
+
+class LogTailer(threading.Thread):
+    """
+    Follows the active EDEX log across rotations and dispatches each new line to the subscribed watchers.
+    Uses inotify when pyinotify is available, polling otherwise.
+    """
+    def __init__(self, log_dir, logfile=None, poll_interval=POLL_INTERVAL):
+        """
+        :param log_dir:  EDEX log directory
+        :param logfile:  open log file to continue from, by default the active log is followed from its end
+        :param poll_interval:  maximum time between checks for new data
+        """
+        super(LogTailer, self).__init__(name='LogTailer')
+        self.daemon = True
+        self.log_dir = log_dir
+        self.poll_interval = poll_interval
+        self.watchers = []
+        self.lines = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._partial = ''
+        self._notifier = None
+        self._last_rotation_check = 0
+        # inodes of the files followed so far, an older log written to again is never read again
+        self._followed = set()
+
+        self.fh = logfile
+        self.path = logfile.name if logfile is not None else None
+        if self.fh is None:
+            self._open(find_active_log(log_dir), from_end=True)
+        else:
+            self._followed.add(os.fstat(self.fh.fileno()).st_ino)
+
+    def subscribe(self, expected_string, expected_count=1, callback=None):
+        """
+        Register a new watcher
+        :return:  LogWatcher
+        """
+        watcher = LogWatcher(expected_string, expected_count=expected_count, callback=callback)
+        with self._lock:
+            self.watchers.append(watcher)
+        return watcher
+
+    def unsubscribe(self, watcher):
+        with self._lock:
+            if watcher in self.watchers:
+                self.watchers.remove(watcher)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        if pyinotify is not None:
+            try:
+                wm = pyinotify.WatchManager()
+                mask = pyinotify.IN_MODIFY | pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO
+                wm.add_watch(self.log_dir, mask)
+                self._notifier = pyinotify.Notifier(wm, default_proc_fun=_Wakeup())
+            except (OSError, pyinotify.WatchManagerError) as e:
+                log.warn('unable to watch %s with inotify, polling - %s', self.log_dir, e)
+                self._notifier = None
+
+        log.info('following EDEX log in %s (%s)', self.log_dir, 'inotify' if self._notifier else 'polling')
+        while not self._stop_event.is_set():
+            self._read()
+            self._check_rotation()
+            self._wait()
+
+        if self._notifier is not None:
+            self._notifier.stop()
+
+    def _wait(self):
+        if self._notifier is None:
+            time.sleep(self.poll_interval)
+        elif self._notifier.check_events(timeout=int(self.poll_interval * 1000)):
+            self._notifier.read_events()
+            self._notifier.process_events()
+
+    def _open(self, path, from_end=False):
+        if self.fh is not None:
+            self.fh.close()
+        self.fh = None
+        self.path = path
+        self._partial = ''
+        if path is None:
+            return
+
+        try:
+            self.fh = open(path, 'r')
+        except IOError as e:
+            log.error('unable to open log file %s - %s', path, e)
+            return
+        self._followed.add(os.fstat(self.fh.fileno()).st_ino)
+
+        if from_end:
+            self.fh.seek(0, 2)
+        log.info('following log file: %s', path)
+
+    def _read(self):
+        if self.fh is None:
+            return
+
+        # seeking to the current position clears the (sticky) end of file indicator
+        self.fh.seek(0, 1)
+        data = self.fh.read()
+        if not data:
+            return
+
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+
+        with self._lock:
+            watchers = list(self.watchers)
+
+        for line in lines:
+            self.lines += 1
+            for watcher in watchers:
+                watcher.feed(line)
+
+    def _check_rotation(self):
+        now = time.time()
+        if now - self._last_rotation_check < ROTATION_CHECK_INTERVAL:
+            return
+        self._last_rotation_check = now
+
+        path = find_active_log(self.log_dir)
+        if path is None:
+            return
+
+        try:
+            inode = os.stat(path).st_ino
+        except OSError:
+            return
+
+        if self.fh is not None and inode == os.fstat(self.fh.fileno()).st_ino:
+            # same file, possibly renamed, keep the offset unless it was truncated
+            self.path = path
+            if os.fstat(self.fh.fileno()).st_size < self.fh.tell():
+                log.info('log file truncated: %s', path)
+                self.fh.seek(0)
+                self._partial = ''
+            return
+
+        if inode in self._followed:
+            # an older log, already read
+            return
+
+        # rotated, the open handle still refers to the old file (whatever it was renamed to),
+        # drain it before following the new log from its start
+        self._read()
+        self._open(path)
+        self._read()
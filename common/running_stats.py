@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+import math
+import random
+
+import numpy
+
+
+DEFAULT_SKETCH_SIZE = 1024
+
+
+class RunningStats(object):
+    """
+    Single pass count/min/max/mean/variance (Welford, merged chunk by chunk).
+    Chunks are arrays of shape (n,) or (n, columns), statistics are kept per column.
+    """
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.mean = None
+        self.m2 = None
+
+    def update(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        n = values.shape[0]
+        if n == 0:
+            return
+
+        mean = values.mean(axis=0)
+        m2 = ((values - mean) ** 2).sum(axis=0)
+        v_min = values.min(axis=0)
+        v_max = values.max(axis=0)
+
+        if self.count == 0:
+            self.mean, self.m2, self.min, self.max = mean, m2, v_min, v_max
+        else:
+            total = self.count + n
+            delta = mean - self.mean
+            self.mean = self.mean + delta * n / total
+            self.m2 = self.m2 + m2 + delta ** 2 * self.count * n / total
+            self.min = numpy.minimum(self.min, v_min)
+            self.max = numpy.maximum(self.max, v_max)
+        self.count += n
+
+    @property
+    def variance(self):
+        if self.count == 0:
+            return float('nan')
+        return self.m2 / self.count
+
+    @property
+    def std(self):
+        return numpy.sqrt(self.variance)
+
+
+class QuantileSketch(object):
+    """
+    Bounded memory quantile estimate (compactor based, in the style of the KLL sketch).
+    Each level holds at most size values, values promoted to level i carry a weight of 2**i.
+    Results are exact until more than size values have been seen.
+    """
+    def __init__(self, size=DEFAULT_SKETCH_SIZE):
+        self.size = size
+        self.count = 0
+        self.nans = 0
+        self.levels = []
+
+    def update(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64).ravel()
+        nans = numpy.isnan(values)
+        if nans.any():
+            self.nans += int(nans.sum())
+            values = values[~nans]
+        self.count += len(values)
+
+        level = 0
+        while len(values):
+            if level == len(self.levels):
+                self.levels.append(values)
+            else:
+                self.levels[level] = numpy.concatenate((self.levels[level], values))
+
+            if len(self.levels[level]) < self.size:
+                break
+
+            # compact: keep every other sorted value, promoted to the next level
+            compacted = numpy.sort(self.levels[level])
+            self.levels[level] = compacted[:0]
+            values = compacted[random.randint(0, 1)::2]
+            level += 1
+
+    def quantile(self, q):
+        """
+        :param q:  quantile in [0, 1]
+        :return: estimated value, NaN if any NaN values were seen (as numpy.median)
+        """
+        if self.nans or self.count == 0:
+            return float('nan')
+
+        if len(self.levels) == 1:
+            return numpy.percentile(self.levels[0], q * 100)
+
+        values = numpy.concatenate(self.levels)
+        weights = numpy.concatenate([numpy.repeat(2 ** i, len(level)) for i, level in enumerate(self.levels)])
+        order = numpy.argsort(values)
+        cumulative = numpy.cumsum(weights[order])
+        index = numpy.searchsorted(cumulative, q * cumulative[-1])
+        return values[order][min(index, len(values) - 1)]
+
+    def median(self):
+        return self.quantile(.5)
+
+
+class ParameterStats(object):
+    """
+    Streaming statistics for one parameter, overall and (for array parameters) per column.
+    """
+    def __init__(self, sketch_size=DEFAULT_SKETCH_SIZE):
+        self.sketch_size = sketch_size
+        self.records = 0
+        self.overall = RunningStats()
+        self.overall_sketch = QuantileSketch(sketch_size)
+        self.columns = None
+        self.column_sketches = None
+
+    def update(self, values):
+        """
+        :param values:  numpy array with one entry (scalar or array) per record
+        """
+        values = numpy.asarray(values)
+        self.records += values.shape[0]
+        self.overall.update(values.ravel())
+        self.overall_sketch.update(values)
+
+        if values.ndim > 1:
+            values = values.reshape(values.shape[0], -1)
+            if self.columns is None:
+                self.columns = RunningStats()
+                self.column_sketches = [QuantileSketch(self.sketch_size) for _ in xrange(values.shape[1])]
+            self.columns.update(values)
+            for i, sketch in enumerate(self.column_sketches):
+                sketch.update(values[:, i])
+
+    def column_rows(self):
+        """
+        :return: list of (count, min, max, median, mean, sigma) per column
+        """
+        if self.columns is None:
+            return []
+        std = self.columns.std
+        return [(self.records, self.columns.min[i], self.columns.max[i], sketch.median(),
+                 self.columns.mean[i], std[i]) for i, sketch in enumerate(self.column_sketches)]
+
+    def row(self):
+        """
+        :return: (count, min, max, median, mean, sigma) over all values, count being the number of values
+        """
+        return (self.overall.count, self.overall.min, self.overall.max, self.overall_sketch.median(),
+                self.overall.mean, self.overall.std)
+
+
+def wilson_interval(successes, n, z=1.96):
+    """
+    Wilson score confidence interval of a binomial proportion
+    :param successes:  number of successes
+    :param n:  number of trials
+    :param z:  standard normal quantile, 1.96 for a 95% interval
+    :return: (low, high)
+    """
+    if n == 0:
+        return 0.0, 1.0
+    p = float(successes) / n
+    denominator = 1 + z * z / n
+    centre = (p + z * z / (2 * n)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0.0, centre - half_width), min(1.0, centre + half_width)
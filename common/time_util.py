@@ -3,9 +3,15 @@ __author__ = 'sgfoote'
 import re
 from datetime import datetime
 
+import numpy
+
 UNIX_EPOCH_DATETIME = datetime(1970, 1, 1)
 MILLIS_PER_DAY = 24 * 60 * 60 * 1000
 NTP_UNIX_DELTA_SECONDS = 2208988800
+# character positions of the separators in YYYY-MM-DDTHH:MM:SS
+ISO8601_SEPARATORS = {4: '-', 7: '-', 10: 'T', 13: ':', 16: ':'}
+ISO8601_LENGTH = 19
+ISO8601_MAX_FRACTION_DIGITS = 6
 EXTENDED_ISO8601_DATE_REGEX = re.compile("""\\d{4}[_-]?(0[1-9]|1[0-2])[-_]?(0[1-9]|[12][0-9]|
                         3[01])""")
 
@@ -60,4 +66,57 @@ def java_time_from_basic_iso8601_date(date):
     :param date: the datetime object to convert
     :return: an integer representing the input time as milliseconds since the UNIX epoch
     """
-    return (date - UNIX_EPOCH_DATETIME).total_seconds() * 1000
\ No newline at end of file
+    return (date - UNIX_EPOCH_DATETIME).total_seconds() * 1000
+
+
+def iso8601_to_ntp(timestamps):
+    """
+    Convert ISO8601 timestamp strings to NTP times all at once. Accepts YYYY-MM-DDTHH:MM:SS with optional
+    fractional seconds (up to microseconds) and an optional trailing 'Z', e.g. 2014-04-11T16:56:57.774Z or
+    2014-04-11T16:56:57. The format is checked on the characters of all strings at once, so only the
+    datetime64 conversion of the valid strings remains.
+    :param timestamps: sequence of timestamp strings
+    :return: (array of NTP times with NaN for unparseable strings, boolean array flagging the unparseable strings)
+    """
+    ntp = numpy.full(len(timestamps), numpy.nan)
+    if len(timestamps) == 0:
+        return ntp, numpy.zeros(0, dtype=bool)
+
+    # non-ASCII characters become '?', which fails the format check below
+    strings = [t.encode('ascii', 'replace') if isinstance(t, unicode) else t for t in timestamps]
+    strings = numpy.char.rstrip(numpy.array(strings, dtype=str), 'Z')
+    width = max(strings.dtype.itemsize, ISO8601_LENGTH + 1)
+    chars = strings.astype('S%d' % width).view('S1').reshape(len(strings), width)
+
+    digits = (chars >= '0') & (chars <= '9')
+    valid = numpy.ones(len(strings), dtype=bool)
+    for position in xrange(ISO8601_LENGTH):
+        if position in ISO8601_SEPARATORS:
+            valid &= chars[:, position] == ISO8601_SEPARATORS[position]
+        else:
+            valid &= digits[:, position]
+
+    # either the end of the string or a decimal point followed only by 1 to 6 digits
+    end = chars[:, ISO8601_LENGTH] == ''
+    fraction = chars[:, ISO8601_LENGTH + 1:]
+    fraction_length = (fraction != '').sum(axis=1)
+    fraction_digits = digits[:, ISO8601_LENGTH + 1:].sum(axis=1)
+    valid &= end | ((chars[:, ISO8601_LENGTH] == '.') &
+                    (fraction_length > 0) & (fraction_length <= ISO8601_MAX_FRACTION_DIGITS) &
+                    (fraction_digits == fraction_length))
+
+    try:
+        micros = strings[valid].astype('datetime64[us]').astype(numpy.int64)
+    except ValueError:
+        # out of range fields (e.g. month 13), convert one at a time to find them
+        micros = []
+        for index in numpy.flatnonzero(valid):
+            try:
+                micros.append(numpy.datetime64(strings[index], 'us').astype(numpy.int64))
+            except ValueError:
+                valid[index] = False
+        micros = numpy.array(micros, dtype=numpy.int64)
+
+    seconds, fraction_micros = numpy.divmod(micros, 1000000)
+    ntp[valid] = (seconds + fraction_micros / 1e6) + NTP_UNIX_DELTA_SECONDS
+    return ntp, ~valid
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from logger import get_logger
+
+
+log = get_logger()
+
+_spans = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+@contextmanager
+def context(**labels):
+    """
+    Label every span recorded by this thread inside the block (e.g. instrument, stream)
+    """
+    previous = getattr(_local, 'labels', {})
+    _local.labels = dict(previous, **labels)
+    try:
+        yield
+    finally:
+        _local.labels = previous
+
+
+def current_context():
+    return dict(getattr(_local, 'labels', {}))
+
+
+@contextmanager
+def span(phase, **labels):
+    """
+    Time the enclosed block as one span of the given phase
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(phase, start, time.time(), **labels)
+
+
+def record(phase, start, end, **labels):
+    """
+    Record a span, labelled with the current thread context and any extra labels
+    :param phase:  name of the phase (send, ingest_wait, metadata_fetch, data_fetch, json_decode, compare, ...)
+    :param start:  start time (seconds since the epoch)
+    :param end:  end time (seconds since the epoch)
+    :return: the recorded span
+    """
+    entry = current_context()
+    entry.update(labels)
+    entry.update(phase=phase, start=start, end=end, elapsed=end - start)
+    with _lock:
+        _spans.append(entry)
+    return entry
+
+
+def get_spans():
+    with _lock:
+        return list(_spans)
+
+
+def clear():
+    with _lock:
+        del _spans[:]
+
+
+def write_spans(filename):
+    """
+    Write all recorded spans as JSON lines
+    """
+    with open(filename, 'w') as fh:
+        for entry in get_spans():
+            fh.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+def summarize(label, spans=None):
+    """
+    Total the span times per value of a label
+    :param label:  span label to group by (e.g. instrument or stream)
+    :return: list of (total secs, label value, {phase: secs}), slowest first
+    """
+    if spans is None:
+        spans = get_spans()
+
+    totals = {}
+    for entry in spans:
+        value = entry.get(label)
+        if value is None:
+            continue
+        phases = totals.setdefault(value, {})
+        phases[entry['phase']] = phases.get(entry['phase'], 0) + entry['elapsed']
+
+    return sorted(((sum(phases.itervalues()), value, phases) for value, phases in totals.iteritems()),
+                  reverse=True)
+
+
+def format_summary(labels=('instrument', 'stream'), count=10):
+    """
+    :return: report of the slowest values of each label with a per phase breakdown
+    """
+    spans = get_spans()
+    lines = []
+    phases = {}
+    for entry in spans:
+        phases[entry['phase']] = phases.get(entry['phase'], 0) + entry['elapsed']
+    lines.append('Time per phase: ' + ', '.join('%s=%.2fs' % (k, v) for k, v in sorted(phases.iteritems())))
+
+    for label in labels:
+        lines.append('Slowest %d by %s:' % (count, label))
+        for total, value, phases in summarize(label, spans)[:count]:
+            breakdown = ', '.join('%s=%.2fs' % (k, v) for k, v in sorted(phases.iteritems()))
+            lines.append('  %8.2fs %s (%s)' % (total, value, breakdown))
+    return '\n'.join(lines)
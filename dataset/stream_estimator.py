@@ -1,8 +1,14 @@
 """ Stream Estimator.
 
 Usage:
-  stream_estimator.py (-f | --fetch) [--host hostname] [(-i input | --input input)] [<streams> ...]
-  stream_estimator.py (-p | --parse) <dir> [(-i input | --input input)] [(-o output | --output output)]
+  stream_estimator.py (-f | --fetch) [--host hostname] [(-i input | --input input)] [--connections=<n>] [--ttl=<s>]
+                      [<streams> ...]
+  stream_estimator.py (-p | --parse) <dir> [(-i input | --input input)] [(-o output | --output output)] [--workers=<n>]
+  stream_estimator.py (-s | --sample) [--host hostname] [(-i input | --input input)] [(-o output | --output output)]
+                      [--connections=<n>] [--slices=<n>] [--slice-size=<n>] [--ttl=<s>] [<streams> ...]
+  stream_estimator.py (-r | --report) [--host hostname] (-i input | --input input) [(-o output | --output output)]
+                      [--months=<n>] [--top=<n>] [--active-days=<n>] [--scenario=<spec>...] [--ttl=<s>]
+  stream_estimator.py --toc-diff [--host hostname]
   stream_estimator.py (-i input | --input input)
   stream_estimator.py -h | --help
   stream_estimator.py --version
@@ -12,31 +18,91 @@ Options:
   --version                   Show version.
   --fetch                     Fetch NetCDF data for listed streams (or all missing data streams).
   --parse                     Parse NetCDF data files in and below dir and gather size statistics.
+  -s --sample                 Estimate sizes of the listed streams (or all missing data streams) from small
+                              limit bounded requests spread over each stream's time range.
+  -r --report                 Project storage from the size estimates and the particle counts and time ranges
+                              of the TOC: totals per array, monthly growth and the largest consumers.
+  --toc-diff                  Refresh the TOC snapshot (regardless of --ttl) and list the sources added, removed
+                              or changed since the snapshot was last written (by any mode), which is kept
+                              as the .prev snapshot.
+  --ttl=<s>                   Seconds the TOC snapshot is used without checking the server, 0 to always check
+                              [default: 3600].
   --host hostname             Hostname for OOI CI services [default: ooiufs01.ooi.rutgers.edu].
+  --connections=<n>           Number of concurrent NetCDF requests [default: 4].
   -i input, --input input     Read previous size estimate file.  If no other arguments are provided, will list
                               all streams that do not have a size estimate.
   -o output, --output output  Specify new output for updates to the size estimate.
+  --slices=<n>                Number of requests per stream source when sampling [default: 6].
+  --slice-size=<n>            Maximum particles per sampling request [default: 1000].
+  --workers=<n>               Number of processes reading NetCDF headers, 0 for one per CPU [default: 0].
+  --months=<n>                Projection horizon in months [default: 12].
+  --top=<n>                   Number of largest consumers to list [default: 10].
+  --active-days=<n>           Sources with data within this many days of the latest TOC data are growing
+                              [default: 30].
+  --scenario=<spec>           What-if scenario, may be repeated.  rate:<pattern>:<factor> scales the particle
+                              rate of the matching sources (e.g. a sample rate change), add:<pattern>:<n> adds
+                              n deployments like each matching source.  Patterns match refdes/stream/method
+                              (e.g. 'CE*/*/telemetered').
 
 """
 # stream_estimator.py (-f | --fetch) [-i input] [--limit=<count>]
-from docopt import docopt
+from docopt import docopt, DocoptExit
 
 import csv
 import fnmatch
+import glob
+import hashlib
+import math
 import os
+import tempfile
 from collections import Counter, namedtuple
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from threading import Lock
 
+import cPickle
 import ntplib
+import numpy
 import requests
+import requests.adapters
 import json
 import time
 from datetime import datetime
 from dateutil.parser import parse
 import xarray as xr
 
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
 EDEX_BASE_URL = 'http://%s:12576/sensor/inv/%s/%s/%s'
 DEFAULT_HOST = 'ooiufs01.ooi.rutgers.edu'
 
+FETCH_CHUNK_SIZE = 1024 * 1024
+FETCH_RETRIES = 5
+FETCH_RETRY_DELAY = 2  # seconds, doubled after each failed attempt
+FETCH_TIMEOUT = (10, 300)  # seconds to connect, seconds without receiving any data
+DEFAULT_CONNECTIONS = 4
+
+# sampling: each source's requests cycle through these fractions of the slice size, so that the
+# fit of bytes against particles separates the per-file overhead from the size of a particle
+SAMPLE_SLICES = 6
+SAMPLE_SLICE_SIZE = 1000
+SAMPLE_SLICE_FRACTIONS = (.25, .5, 1.)
+MAX_SAMPLE_SOURCES = 5
+
+# two-sided 95% Student's t quantiles by degrees of freedom (normal above 30)
+T_975 = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262, 10: 2.228,
+         15: 2.131, 20: 2.086, 30: 2.042}
+
+# TOC snapshot, --toc-diff keeps the snapshot it compared against with a .prev suffix
+TOC_SNAPSHOT = '.stream_estimator_toc.pkl'
+DEFAULT_TOC_TTL = 3600
+
+# particle count and stream of previously scanned NetCDF files, by path (valid while size and mtime match)
+HEADER_CACHE = '.stream_estimator_headers.json'
+
 
 def timestamp_to_ntp(ts):
     dt = parse(ts).replace(tzinfo=None)
@@ -58,22 +124,38 @@ def ntptime_to_string(t):
     return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t)) + millis + 'Z'
 
 
-def get_from_edex(hostname, subsite, node, sensor, method, stream, start_time, stop_time, limit=None):
+class FetchProgress(object):
     """
-    Retrieve all stored sensor data from edex
-
-    :param hostname:  url for uframe server (e.g. http://ooiufs01.rutgers.edu, localhost)
-    :param subsite:  array (e.g. RS03AXPS)
-    :param node:  mooring (e.g. RID01)
-    :param sensor:  instrument port and sensor (e.g. 05-PARADA101)
-    :param method:  method type (e.g. telemetered, streamed, recovered)
-    :param stream:  stream name (e.g. )
-    :param start_time:  begin time (NTP) for retrieval window
-    :param stop_time:  end time (NTP) for retrieval window
-    :param limit:  when set, this will be a synchronous request and data will be sub-sampled to specified value
-    :return: nothing
+    Thread safe progress of a set of fetches
+    """
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.lock = Lock()
+
+    def add_bytes(self, count):
+        with self.lock:
+            self.bytes += count
+
+    def finished(self, name, ok=True):
+        with self.lock:
+            self.done += 1
+            if not ok:
+                self.failed += 1
+            elapsed = time.time() - self.start
+            remaining = elapsed / self.done * (self.total - self.done)
+            print '  [%d/%d] %s %s - %.1f MB in %.0fs (%.2f MB/s), about %.0fs remaining' % \
+                  (self.done, self.total, name, 'complete' if ok else 'FAILED', self.bytes / 1e6, elapsed,
+                   self.bytes / 1e6 / max(elapsed, 1e-3), remaining)
+
+
+def edex_request(hostname, subsite, node, sensor, method, stream, start_time, stop_time, limit=None):
+    """
+    :return: (url, parameters) of a NetCDF request
     """
-
     url = EDEX_BASE_URL % (hostname, subsite, node, sensor) + '/%s/%s' % (method, stream)
     data = {}
 
@@ -86,39 +168,389 @@ def get_from_edex(hostname, subsite, node, sensor, method, stream, start_time, s
     data['user'] = 'estimator'
     if limit:
         data['limit'] = limit
+    return url, data
+
+
+def get_slice_from_edex(session, hostname, subsite, node, sensor, method, stream, start_time, stop_time, limit):
+    """
+    Retrieve a small, limit bounded, NetCDF slice of a stream
+    :return: (particle count, size in bytes) of the response, particle count is None on failure
+    """
+    url, data = edex_request(hostname, subsite, node, sensor, method, stream, start_time, stop_time, limit)
+    try:
+        r = session.get(url, params=data, timeout=FETCH_TIMEOUT)
+        r.raise_for_status()
+    except requests.RequestException as e:
+        print '  slice request failed - %s' % e
+        return None, 0
+
+    fd, slice_file = tempfile.mkstemp(suffix='.nc')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(r.content)
+        particles, _ = read_netcdf_header(slice_file)
+    finally:
+        os.remove(slice_file)
+    return particles, len(r.content)
+
+
+def t_975(df):
+    """
+    :return: two-sided 95% Student's t quantile, rounded to the conservative side between table entries
+    """
+    if df > max(T_975):
+        return 1.96
+    return T_975[max(k for k in T_975 if k <= df)]
+
+
+def fit_bytes_per_particle(samples):
+    """
+    Least squares fit of bytes = overhead + bytes per particle * particles
+    :param samples:  list of (particles, bytes)
+    :return: (bytes per particle, half width of its 95% confidence interval), the interval is None when there
+             are too few samples, bytes per particle is None without samples.  Falls back to the ratio of the
+             totals when the particle counts don't vary or the fit is not positive.
+    """
+    if not samples:
+        return None, None
+
+    x = numpy.array([p for p, _ in samples], dtype=numpy.float64)
+    y = numpy.array([b for _, b in samples], dtype=numpy.float64)
+    ratio = y.sum() / x.sum()
+    if len(samples) < 3 or x.std() == 0:
+        return ratio, None
+
+    slope, intercept = numpy.polyfit(x, y, 1)
+    if slope <= 0:
+        return ratio, None
+
+    residuals = y - (intercept + slope * x)
+    stderr = math.sqrt((residuals ** 2).sum() / (len(samples) - 2) / ((x - x.mean()) ** 2).sum())
+    return slope, t_975(len(samples) - 2) * stderr
+
+
+def get_from_edex(hostname, subsite, node, sensor, method, stream, start_time, stop_time, limit=None,
+                  session=None, progress=None, retries=FETCH_RETRIES):
+    """
+    Retrieve all stored sensor data from edex
+
+    The response is streamed to <stream>-<sensor>.request.<key>.part, key being a hash of the request, and
+    renamed to <stream>-<sensor>.request once complete.  An existing request file is not fetched again, an
+    existing part file of the same request is resumed with a Range request (restarted if the server doesn't
+    support them), those of other requests are removed.  Transient failures, including a response cut short
+    of its Content-Length, are retried with an increasing delay.
+
+    :param hostname:  url for uframe server (e.g. http://ooiufs01.rutgers.edu, localhost)
+    :param subsite:  array (e.g. RS03AXPS)
+    :param node:  mooring (e.g. RID01)
+    :param sensor:  instrument port and sensor (e.g. 05-PARADA101)
+    :param method:  method type (e.g. telemetered, streamed, recovered)
+    :param stream:  stream name (e.g. )
+    :param start_time:  begin time (NTP) for retrieval window
+    :param stop_time:  end time (NTP) for retrieval window
+    :param limit:  when set, this will be a synchronous request and data will be sub-sampled to specified value
+    :param session:  requests session to use (connection pooling)
+    :param progress:  FetchProgress updated with the bytes received
+    :param retries:  number of attempts after the first
+    :return: True if the request file is complete
+    """
+    url, data = edex_request(hostname, subsite, node, sensor, method, stream, start_time, stop_time, limit)
 
-    print 'fetching NetCDF for %s...' % url
     request_file = os.path.join('%s-%s.request' % (stream, sensor))
-    with open(request_file, 'wb') as fh:
-        r = requests.get(url, params=data)
-        fh.write(r.content)
+    if os.path.exists(request_file):
+        print '  already fetched - %s' % request_file
+        return True
+
+    session = session or requests.Session()
+    key = hashlib.sha1(url + json.dumps(data, sort_keys=True)).hexdigest()[:12]
+    part_file = '%s.%s.part' % (request_file, key)
+    for stale in glob.glob(request_file + '.*.part'):
+        if stale != part_file:
+            print '  discarding partial fetch of a different request - %s' % stale
+            os.remove(stale)
+
+    delay = FETCH_RETRY_DELAY
+    for attempt in xrange(retries + 1):
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        print 'fetching NetCDF for %s%s...' % (url, ' (resuming at %d bytes)' % offset if offset else '')
+        try:
+            r = session.get(url, params=data, headers=headers, stream=True, timeout=FETCH_TIMEOUT)
+            if r.status_code == 416:
+                # nothing left to fetch
+                break
+            r.raise_for_status()
+
+            # the server ignored the Range request, start over
+            mode = 'ab' if offset and r.status_code == 206 else 'wb'
+            with open(part_file, mode) as fh:
+                for chunk in r.iter_content(FETCH_CHUNK_SIZE):
+                    fh.write(chunk)
+                    if progress is not None:
+                        progress.add_bytes(len(chunk))
+
+            # a connection closed early just ends the content, check that all of it arrived (as sent,
+            # before any content decoding), the part file is resumed by the next attempt
+            expected = r.headers.get('Content-Length')
+            if expected is not None and r.raw.tell() < int(expected):
+                raise IOError('connection closed after %d of %s bytes' % (r.raw.tell(), expected))
+            break
+        except (requests.RequestException, IOError) as e:
+            response = getattr(e, 'response', None)
+            if response is not None and response.status_code < 500:
+                print '  request failed - %s' % e
+                return False
+            if attempt == retries:
+                print '  request failed after %d attempts - %s' % (attempt + 1, e)
+                return False
+            print '  request failed (%s), retrying in %ds' % (e, delay)
+            time.sleep(delay)
+            delay *= 2
+
+    os.rename(part_file, request_file)
     print '  request complete - %s' % request_file
+    return True
+
+
+def read_netcdf_header(filename):
+    """
+    Read the particle count and stream name of a NetCDF file from its header, without reading any data
+    :param filename:  NetCDF file
+    :return: (particle count, stream name), particle count is None if the file has no obs dimension
+    """
+    try:
+        if netCDF4 is not None:
+            ds = netCDF4.Dataset(filename)
+            try:
+                particles = len(ds.dimensions['obs']) if 'obs' in ds.dimensions else None
+                return particles, getattr(ds, 'stream', None)
+            finally:
+                ds.close()
+
+        ds = xr.open_dataset(filename, decode_times=False, decode_coords=False, mask_and_scale=False)
+        try:
+            return ds.dims.get('obs'), ds.attrs.get('stream')
+        finally:
+            ds.close()
+    except (IOError, RuntimeError, ValueError) as e:
+        print '  unable to read %s: %s' % (filename, e)
+        return None, None
+
+
+def read_header_cache(filename):
+    try:
+        with open(filename) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_header_cache(filename, cache):
+    temp_file = filename + '.tmp'
+    with open(temp_file, 'w') as fh:
+        json.dump(cache, fh)
+    os.rename(temp_file, filename)
+
+
+SECONDS_PER_MONTH = 365.25 / 12 * 24 * 60 * 60
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def format_bytes(count):
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(count) < 1024:
+            return '%.1f %s' % (count, unit)
+        count /= 1024.
+    return '%.1f PB' % count
 
 
 StreamInfo = namedtuple('StreamInfo', ['count', 'refdes', 'stream', 'method', 'begin', 'end'])
 
 
+# storage of one stream source (instrument, stream and delivery method), monthly is 0 for inactive sources
+SourceProjection = namedtuple('SourceProjection', ['refdes', 'stream', 'method', 'particles', 'size', 'bytes',
+                                                   'monthly'])
+
+
+SCENARIO_KINDS = ('rate', 'add')
+
+
+def parse_scenario(spec):
+    """
+    :param spec:  rate:<pattern>:<factor> or add:<pattern>:<deployments>
+    :return: (kind, pattern, value)
+    :raises ValueError: if the spec is malformed
+    """
+    parts = spec.split(':', 2)
+    if len(parts) != 3 or not parts[1]:
+        raise ValueError('scenario %r is not of the form <kind>:<pattern>:<value>' % spec)
+    kind, pattern, value = parts
+    if kind not in SCENARIO_KINDS:
+        raise ValueError('unknown scenario type %r in %r, expected one of %s' % (kind, spec, ', '.join(SCENARIO_KINDS)))
+    try:
+        value = float(value)
+    except ValueError:
+        raise ValueError('scenario value %r in %r is not a number' % (value, spec))
+    if value < 0 or math.isnan(value) or math.isinf(value):
+        raise ValueError('scenario value %r in %r must be a non-negative number' % (value, spec))
+    return kind, pattern, value
+
+
+def apply_scenario(projections, spec):
+    """
+    Apply a what-if scenario to the projected sources
+    :param projections:  list of SourceProjection
+    :param spec:  rate:<pattern>:<factor> or add:<pattern>:<deployments>, see parse_scenario
+    :return: list of SourceProjection
+    """
+    kind, pattern, value = parse_scenario(spec)
+
+    result = []
+    for sp in projections:
+        if not fnmatch.fnmatch('%s/%s/%s' % (sp.refdes, sp.stream, sp.method), pattern):
+            result.append(sp)
+        elif kind == 'rate':
+            result.append(sp._replace(monthly=sp.monthly * value))
+        else:
+            # add, new deployments start empty and grow like the existing one
+            result.append(sp)
+            result.append(sp._replace(refdes=sp.refdes + ' (+%g)' % value, particles=0, bytes=0,
+                                      monthly=sp.monthly * value))
+    return result
+
+
+def summarize_projection(projections, months):
+    """
+    :return: (total bytes, monthly growth, projected bytes after months, {array: (bytes, monthly growth)})
+    """
+    arrays = {}
+    for sp in projections:
+        total, monthly = arrays.get(sp.refdes[:2], (0, 0))
+        arrays[sp.refdes[:2]] = (total + sp.bytes, monthly + sp.monthly)
+    total = sum(sp.bytes for sp in projections)
+    monthly = sum(sp.monthly for sp in projections)
+    return total, monthly, total + monthly * months, arrays
+
+
+def read_snapshot(filename):
+    try:
+        with open(filename, 'rb') as fh:
+            return cPickle.load(fh)
+    except (IOError, EOFError, AttributeError, ImportError, cPickle.UnpicklingError):
+        return None
+
+
+def write_snapshot(filename, snapshot):
+    temp_file = filename + '.tmp'
+    with open(temp_file, 'wb') as fh:
+        cPickle.dump(snapshot, fh, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temp_file, filename)
+
+
+def snapshot_stream_map(snapshot):
+    return dict((k, [StreamInfo(*si) for si in v]) for k, v in snapshot['stream_map'].iteritems())
+
+
+def diff_stream_maps(old, new):
+    """
+    Compare the sources of two stream maps
+    :return: (added, removed, changed) lists, of StreamInfo for added and removed sources and of
+             (old StreamInfo, new StreamInfo) for sources whose count or time range changed
+    """
+    def by_source(stream_map):
+        return dict(((si.refdes, si.stream, si.method), si)
+                    for sources in stream_map.itervalues() for si in sources)
+
+    old = by_source(old)
+    new = by_source(new)
+    added = [new[k] for k in sorted(set(new) - set(old))]
+    removed = [old[k] for k in sorted(set(old) - set(new))]
+    changed = [(old[k], new[k]) for k in sorted(set(old) & set(new)) if old[k] != new[k]]
+    return added, removed, changed
+
+
 class StreamEstimator:
-    def __init__(self, hostname=DEFAULT_HOST):
+    def __init__(self, hostname=DEFAULT_HOST, snapshot=TOC_SNAPSHOT, ttl=DEFAULT_TOC_TTL):
         """
-
+        :param hostname:  uFrame host
+        :param snapshot:  TOC snapshot file, None to always fetch the TOC
+        :param ttl:  seconds the snapshot is used without checking the server
         """
         self.sizes = {}  # in Bytes per particle for associated NetCDF file
+        self.sample_stats = {}  # sampling details per stream
         self.stream_count = Counter()
         self.host = hostname
         self.port = 12576
         self.base_url = 'http://%s:%d/sensor/inv' % (self.host, self.port)
         self.toc_url = 'http://%s:%d/sensor/inv/toc' % (self.host, self.port)
         self.toc = {}
+        self.stream_map = {}
+        self.snapshot = snapshot
+        self.ttl = ttl
 
-    def _get_toc(self):
+    def _get_toc(self, refresh=False):
+        """
+        load the TOC, from the snapshot while it is fresh, otherwise refreshed from the server with a
+        conditional request (ETag / Last-Modified) so an unchanged TOC isn't transferred or parsed again
+        :param refresh:  check the server even if the snapshot is fresh
+        """
         if self.toc:
             return
 
+        snapshot = read_snapshot(self.snapshot) if self.snapshot else None
+        if snapshot is not None and snapshot['url'] != self.toc_url:
+            snapshot = None
+
+        if snapshot is not None and not refresh and time.time() - snapshot['fetched'] < self.ttl:
+            print 'Using Table of Contents snapshot from %s' % time.ctime(snapshot['fetched'])
+            self.toc = snapshot['toc']
+            self.stream_map = snapshot_stream_map(snapshot)
+            return
+
+        headers = {}
+        if snapshot is not None:
+            if snapshot.get('etag'):
+                headers['If-None-Match'] = snapshot['etag']
+            if snapshot.get('last_modified'):
+                headers['If-Modified-Since'] = snapshot['last_modified']
+
         print 'Fetching Table of Contents...'
-        r = requests.get(self.toc_url)
-        self.toc = json.loads(r.content)
+        r = requests.get(self.toc_url, headers=headers)
+        if r.status_code == 304 and snapshot is not None:
+            print '  unchanged since %s' % time.ctime(snapshot['fetched'])
+            self.toc = snapshot['toc']
+            self.stream_map = snapshot_stream_map(snapshot)
+        else:
+            r.raise_for_status()
+            self.toc = json.loads(r.content)
+            self._build_stream_map()
+
+            # plain tuples, StreamInfo pickles refer to the module it was run as
+            stream_map = dict((k, [tuple(si) for si in v]) for k, v in self.stream_map.iteritems())
+            snapshot = {'url': self.toc_url, 'toc': self.toc, 'stream_map': stream_map,
+                        'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')}
+
+        if self.snapshot:
+            snapshot['fetched'] = time.time()
+            write_snapshot(self.snapshot, snapshot)
 
+    def toc_diff(self):
+        """
+        refresh the TOC and compare it with the snapshot as it was before the refresh, whether the server
+        reports the TOC unchanged (304) or sends it again; the snapshot compared against is kept as .prev
+        :return: see diff_stream_maps, None if there is no previous snapshot
+        """
+        previous = read_snapshot(self.snapshot) if self.snapshot else None
+        if previous is not None and previous['url'] != self.toc_url:
+            previous = None
+
+        self._get_toc(refresh=True)
+        if previous is None:
+            return None
+        write_snapshot(self.snapshot + '.prev', previous)
+        return diff_stream_maps(snapshot_stream_map(previous), self.stream_map)
+
+    def _build_stream_map(self):
         self.stream_map = {}
         for instrument in self.toc['instruments']:
             for stream in instrument['streams']:
@@ -160,11 +592,11 @@ class StreamEstimator:
 
         return sorted(set(self.stream_count) - set(self.sizes))
 
-    def _fetch_netcdf(self, si):
+    def _fetch_netcdf(self, si, session=None, progress=None):
         """
         fetch NetCDF file for given stream
         :param si:  StreamInfo object defining stream to fetch
-        :return:  nothing - return is synchronous if limit is not 0
+        :return:  True if the request completed - return is synchronous if limit is not 0
         """
         subsite, node, sensor = si.refdes.split('-', 2)
 
@@ -175,43 +607,266 @@ class StreamEstimator:
             duration = end - begin
             duration /= si.count / 100000
             end = begin + duration
-        get_from_edex(self.host, subsite, node, sensor, si.method, si.stream, begin, end)
+        return get_from_edex(self.host, subsite, node, sensor, si.method, si.stream, begin, end,
+                             session=session, progress=progress)
 
-    def fetch_streams(self, streams):
+    def fetch_streams(self, streams, connections=DEFAULT_CONNECTIONS):
         """
         get NetCDF files for the given streams
         :param streams:  list of stream names
+        :param connections:  number of concurrent requests
         :return: nothing - will have to rerun parse_netcdf after asynchronous collection
         """
         self._get_toc()
 
+        # find the streams in the TOC
+        selected = []
         for mstream in streams:
-            # find the stream in the TOC and make a NetCDF request
             sources = self.stream_map.get(mstream)
             if sources is not None:
                 sources.sort()
-                si = sources[-1]
-                self._fetch_netcdf(si)
+                selected.append(sources[-1])
+
+        # make the NetCDF requests
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+        session.mount('http://', adapter)
+        progress = FetchProgress(len(selected))
 
-    def parse_netcdf(self, directory):
+        def fetch(si):
+            progress.finished(si.stream, self._fetch_netcdf(si, session, progress))
+
+        pool = ThreadPool(connections)
+        try:
+            pool.map(fetch, selected)
+        finally:
+            pool.close()
+
+        print 'fetched %d of %d streams (%.1f MB)' % (progress.done - progress.failed, len(selected),
+                                                       progress.bytes / 1e6)
+
+    def project(self, active_days=30):
+        """
+        combine the size estimates with the particle counts and time ranges of the TOC
+        :param active_days:  sources with data within this many days of the latest data in the TOC are growing
+        :return: (list of SourceProjection, number of particles of streams without a size estimate)
+        """
+        self._get_toc()
+
+        sources = [si for stream_sources in self.stream_map.itervalues() for si in stream_sources]
+        if not sources:
+            return [], 0
+        latest = max(si.end for si in sources)
+
+        projections = []
+        unsized = 0
+        for si in sources:
+            if si.stream not in self.sizes:
+                unsized += si.count
+                continue
+
+            size = float(self.sizes[si.stream])
+            monthly = 0.
+            duration = si.end - si.begin
+            if duration > 0 and latest - si.end <= active_days * SECONDS_PER_DAY:
+                monthly = si.count / duration * SECONDS_PER_MONTH * size
+            projections.append(SourceProjection(si.refdes, si.stream, si.method, si.count, size,
+                                                si.count * size, monthly))
+        return projections, unsized
+
+    def report_projection(self, filename, months=12, top=10, active_days=30, scenarios=()):
+        """
+        print the storage projection (per array, largest consumers and what-if scenarios) and write the
+        projection of each source
+        :param filename:  output CSV file
+        :param months:  projection horizon
+        :param top:  number of largest consumers to list
+        :param active_days:  see project
+        :param scenarios:  what-if scenario specifications, see apply_scenario
+        :return:
+        """
+        projections, unsized = self.project(active_days)
+        total, monthly, projected, arrays = summarize_projection(projections, months)
+
+        print 'Storage projection (%d sources, %d particles without a size estimate)' % (len(projections), unsized)
+        print '  current: %s  growth: %s/month  in %d months: %s' % \
+              (format_bytes(total), format_bytes(monthly), months, format_bytes(projected))
+
+        print 'Per array:'
+        for array, (array_total, array_monthly) in sorted(arrays.iteritems(), key=lambda x: x[1], reverse=True):
+            print '  %-4s %12s %12s/month %12s in %d months' % \
+                  (array, format_bytes(array_total), format_bytes(array_monthly),
+                   format_bytes(array_total + array_monthly * months), months)
+
+        for title, key in [('Largest consumers', lambda x: x.bytes), ('Fastest growing', lambda x: x.monthly)]:
+            print '%s:' % title
+            for sp in sorted(projections, key=key, reverse=True)[:top]:
+                print '  %12s %12s/month  %s %s %s' % \
+                      (format_bytes(sp.bytes), format_bytes(sp.monthly), sp.refdes, sp.stream, sp.method)
+
+        for spec in scenarios:
+            _, scenario_monthly, scenario_projected, _ = summarize_projection(apply_scenario(projections, spec),
+                                                                              months)
+            print 'Scenario %s: growth %s/month (%+.1f%%), in %d months: %s' % \
+                  (spec, format_bytes(scenario_monthly),
+                   100 * (scenario_monthly - monthly) / monthly if monthly else 0,
+                   months, format_bytes(scenario_projected))
+
+        with open(filename, 'wb') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['array'] + list(SourceProjection._fields))
+            for sp in sorted(projections):
+                writer.writerow([sp.refdes[:2]] + list(sp))
+
+    def _slices(self, si, slices, slice_size):
+        """
+        plan the sampling requests of one stream source, spread evenly over its time range
+        :return: list of (start, stop, limit)
+        """
+        duration = si.end - si.begin
+        if si.count <= slice_size or duration <= 0:
+            return [(si.begin, si.end, slice_size)]
+
+        plan = []
+        for i in xrange(slices):
+            limit = max(1, int(slice_size * SAMPLE_SLICE_FRACTIONS[i % len(SAMPLE_SLICE_FRACTIONS)]))
+            # a window expected to hold about limit particles
+            span = min(duration, duration * limit / si.count)
+            start = si.begin + (duration - span) * (i + .5) / slices
+            plan.append((start, start + span, limit))
+        return plan
+
+    def sample_streams(self, streams, slices=SAMPLE_SLICES, slice_size=SAMPLE_SLICE_SIZE,
+                       connections=DEFAULT_CONNECTIONS):
+        """
+        estimate bytes per particle from small NetCDF slices of each stream (and up to MAX_SAMPLE_SOURCES of its
+        sources), instead of downloading the bulk of the stream
+        - overwrites existing particle statistics of the sampled streams
+        :param streams:  list of stream names
+        :param slices:  number of requests per source
+        :param slice_size:  maximum particles per request
+        :param connections:  number of concurrent requests
+        """
+        self._get_toc()
+
+        requests_plan = []
+        for mstream in streams:
+            sources = sorted(self.stream_map.get(mstream, []), reverse=True)[:MAX_SAMPLE_SOURCES]
+            for si in sources:
+                for start, stop, limit in self._slices(si, slices, slice_size):
+                    requests_plan.append((si, start, stop, limit))
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+        session.mount('http://', adapter)
+        progress = FetchProgress(len(requests_plan))
+
+        def fetch(args):
+            si, start, stop, limit = args
+            subsite, node, sensor = si.refdes.split('-', 2)
+            particles, nbytes = get_slice_from_edex(session, self.host, subsite, node, sensor, si.method,
+                                                    si.stream, start, stop, limit)
+            progress.add_bytes(nbytes)
+            progress.finished('%s %s' % (si.refdes, si.stream), particles is not None)
+            return si, particles, nbytes
+
+        print 'sampling %d streams with %d requests' % (len(streams), len(requests_plan))
+        pool = ThreadPool(connections)
+        try:
+            results = pool.map(fetch, requests_plan)
+        finally:
+            pool.close()
+
+        by_stream = {}
+        for si, particles, nbytes in results:
+            if particles:
+                by_stream.setdefault(si.stream, {}).setdefault((si.refdes, si.method), []).append((particles, nbytes))
+
+        for stream_name, by_source in sorted(by_stream.iteritems()):
+            samples = [sample for source in by_source.itervalues() for sample in source]
+            size, half_width = fit_bytes_per_particle(samples)
+
+            # variation of the bytes per particle between the sources (instruments and delivery methods)
+            source_sizes = [fit_bytes_per_particle(source)[0] for source in by_source.itervalues()]
+            source_cv = numpy.std(source_sizes) / numpy.mean(source_sizes) if len(source_sizes) > 1 else 0.
+
+            self.sizes[stream_name] = size
+            self.sample_stats[stream_name] = {
+                'slices': len(samples),
+                'sources': len(by_source),
+                'particles': sum(p for p, _ in samples),
+                'bytes': sum(b for _, b in samples),
+                'ci_low': size - half_width if half_width is not None else '',
+                'ci_high': size + half_width if half_width is not None else '',
+                'source_cv': source_cv,
+            }
+            print '  %s: %.1f bytes per particle%s (%d slices, %d sources, source variation %.1f%%)' % \
+                  (stream_name, size, ' +/- %.1f' % half_width if half_width is not None else '',
+                   len(samples), len(by_source), 100 * source_cv)
+
+        missing = set(streams) - set(by_stream)
+        if missing:
+            print 'unable to sample %d streams: %s' % (len(missing), ', '.join(sorted(missing)))
+        print 'transferred %.1f MB' % (progress.bytes / 1e6)
+
+    def write_sample_report(self, filename):
+        """
+        write the sampling details of each sampled stream
+        :param filename:
+        :return:
+        """
+        columns = ['slices', 'sources', 'particles', 'bytes', 'ci_low', 'ci_high', 'source_cv']
+        with open(filename, 'wb') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['stream name', 'bytes per particle'] + columns)
+            for key, stats in sorted(self.sample_stats.iteritems()):
+                writer.writerow([key, self.sizes[key]] + [stats[c] for c in columns])
+
+    def parse_netcdf(self, directory, workers=None, cache_file=HEADER_CACHE):
         """
         walk the NetCDF responses and add file sizes returns to the results
         - overwrites existing particle statistics
+        - only the headers are read, in a pool of processes, and cached by path, size and modification time
         :param directory:  directory in which to search for NetCDF files (all subdirectories will be scanned)
+        :param workers:  number of processes reading headers (default one per CPU)
+        :param cache_file:  header cache file, None to disable
         :return:
         """
+        # one stat per file, each directory's files largest first
+        found = []
         for root, dirs, files in os.walk(directory, topdown=False):
-            files.sort(key=lambda f: os.stat(os.path.join(root, f)).st_size, reverse=True)
+            entries = []
             for f in fnmatch.filter(files, '*.nc'):
                 filename = os.path.join(root, f)
-                filesize = os.stat(filename).st_size
-
-                ds = xr.open_dataset(filename, decode_times=False)
-                if 'obs' in ds:
-                    particles = len(ds.obs)
-                    stream_name = ds.attrs['stream']
-                    if stream_name not in self.sizes:
-                        self.sizes[stream_name] = float(filesize) / particles
+                st = os.stat(filename)
+                entries.append((st.st_size, st.st_mtime, filename))
+            entries.sort(key=lambda x: x[0], reverse=True)
+            found.extend(entries)
+
+        cache = read_header_cache(cache_file) if cache_file else {}
+        todo = [filename for filesize, mtime, filename in found
+                if cache.get(filename, [None, None])[:2] != [filesize, mtime]]
+        print '  %d NetCDF files, %d headers to read' % (len(found), len(todo))
+
+        if todo:
+            pool = Pool(workers)
+            try:
+                headers = pool.map(read_netcdf_header, todo, chunksize=16)
+            finally:
+                pool.close()
+                pool.join()
+
+            stats = dict((filename, (filesize, mtime)) for filesize, mtime, filename in found)
+            for filename, (particles, stream_name) in zip(todo, headers):
+                cache[filename] = list(stats[filename]) + [particles, stream_name]
+
+            if cache_file:
+                write_header_cache(cache_file, cache)
+
+        for filesize, mtime, filename in found:
+            particles, stream_name = cache[filename][2:]
+            if particles and stream_name is not None and stream_name not in self.sizes:
+                self.sizes[stream_name] = float(filesize) / particles
 
     def read_config(self, filename):
         """
@@ -243,7 +898,13 @@ class StreamEstimator:
 if __name__ == '__main__':
     arguments = docopt(__doc__, version='Stream Estimator 1.0')
 
-    est = StreamEstimator(arguments['--host'])
+    for spec in arguments['--scenario']:
+        try:
+            parse_scenario(spec)
+        except ValueError as e:
+            raise DocoptExit('invalid --scenario: %s' % e)
+
+    est = StreamEstimator(arguments['--host'], ttl=int(arguments['--ttl']))
 
     # get configuration file
     if arguments['--input']:
@@ -255,16 +916,49 @@ if __name__ == '__main__':
         size_config_file = 'stream_nc_sizes.cfg'
 
     # determine mode
-    if arguments['--fetch']:
+    if arguments['--toc-diff']:
+        diff = est.toc_diff()
+        if diff is None:
+            print 'no previous TOC snapshot to compare with'
+        else:
+            added, removed, changed = diff
+            for si in added:
+                print '  added    %s %s %s (%d particles)' % (si.refdes, si.stream, si.method, si.count)
+            for si in removed:
+                print '  removed  %s %s %s (%d particles)' % (si.refdes, si.stream, si.method, si.count)
+            for old, new in changed:
+                print '  changed  %s %s %s (%+d particles)' % (new.refdes, new.stream, new.method,
+                                                               new.count - old.count)
+            print '%d sources added, %d removed, %d changed' % (len(added), len(removed), len(changed))
+
+    elif arguments['--fetch']:
         if arguments['<streams>']:
             print 'fetching NetCDF for %r' % set(arguments['<streams>'])
-            est.fetch_streams(set(arguments['<streams>']))
+            est.fetch_streams(set(arguments['<streams>']), connections=int(arguments['--connections']))
         else:
             if arguments['--input']:
                 print 'fetching NetCDF for remaining streams'
             else:
                 print 'fetching NetCDF for all streams'
-            est.fetch_streams(est.missing_streams())
+            est.fetch_streams(est.missing_streams(), connections=int(arguments['--connections']))
+
+    elif arguments['--sample']:
+        streams = set(arguments['<streams>']) or est.missing_streams()
+        print 'sampling NetCDF sizes for %d streams' % len(streams)
+        est.sample_streams(streams, slices=int(arguments['--slices']), slice_size=int(arguments['--slice-size']),
+                           connections=int(arguments['--connections']))
+
+        if arguments['--output']:
+            print 'archiving size estimates file %s' % arguments['--output']
+            size_config_file = arguments['--output']
+        est.write_config(size_config_file)
+        est.write_sample_report(os.path.splitext(size_config_file)[0] + '_sampling.csv')
+
+    elif arguments['--report']:
+        output = arguments['--output'] or 'storage_projection.csv'
+        est.report_projection(output, months=int(arguments['--months']), top=int(arguments['--top']),
+                              active_days=int(arguments['--active-days']), scenarios=arguments['--scenario'])
+        print 'projection written to %s' % output
 
     elif arguments['--parse']:
         path = arguments['<dir>']
@@ -273,7 +967,7 @@ if __name__ == '__main__':
             raise Exception('Invalid command line arguments')
 
         print 'parsing NetCDF files in %s' % arguments['<dir>']
-        est.parse_netcdf(arguments['<dir>'])
+        est.parse_netcdf(arguments['<dir>'], workers=int(arguments['--workers']) or None)
 
         if arguments['--output']:
             print 'archiving size estimates file %s' % arguments['--output']
@@ -2,11 +2,23 @@
 """Validate dataset
 
 Usage:
-  validate_dataset.py [--ignore_null]
-  validate_dataset.py [--ignore_null] <test_case>...
+  validate_dataset.py [options] [<test_case>...]
 
 Options:
-  --ignore_null  Don't fail on missing null values
+  --ignore_null           Don't fail on missing null values
+  --netcdf                Retrieve data as NetCDF and compare whole variables at once
+  --windows=<n>           Retrieve each stream in n concurrent time windows [default: 1]
+  --time_tolerance=<ms>   Maximum difference between matching timestamps in milliseconds [default: 1]
+  --yaml_workers=<n>      Number of processes parsing expected results, 0 for one per CPU [default: 0]
+  --sample=<n>            Validate a random sample of about n expected records per stream, stratified by
+                          time, retrieving only the data around the sampled records, 0 for all [default: 0]
+  --seed=<seed>           Random seed, the same seed reproduces the same sample [default: 0]
+  --full                  Validate every test case, including those unchanged since their last passing run
+  --hosts=<hosts>         Comma separated EDEX hosts to shard the test cases across, each as
+                          host[:broker[:log_dir]] (the broker defaults to the host).  The log dir
+                          must be readable from here and is required for every host but localhost,
+                          which defaults to the local EDEX logs; each host needs its own log dir
+                          [default: localhost]
 
 """
 import os
@@ -17,30 +29,69 @@ tools_dir = os.path.dirname(dataset_dir)
 
 sys.path.append(tools_dir)
 
+import re
+import glob
 import json
+import heapq
 import time
+import errno
+import cPickle
+import hashlib
+import tempfile
 import pprint
 import ntplib
 import random
+import resource
 import docopt
-import calendar
 
 from qpid.messaging.exceptions import NotFound
-from datetime import datetime
 from yaml import load
 from common import logger
 from common import edex_tools
+from common import timing
+from common import time_util
 
+from multiprocessing import Pool
 from multiprocessing.pool import ThreadPool
-from threading import RLock
+from threading import Lock
 
-rlock = RLock()
+try:
+    from yaml import CSafeLoader as ExpectedLoader
+except ImportError:
+    from yaml import SafeLoader as ExpectedLoader
 
 IGNORE_NULLS = False
+RETRIEVAL_WINDOWS = 1
+TIME_TOLERANCE = edex_tools.DEFAULT_TIME_TOLERANCE_MS
+NETCDF = False
+YAML_WORKERS = None
+FULL = False
+SAMPLE_SIZE = 0
+SEED = '0'
 VALIDATE_TIMESTAMP = time.strftime('%Y%m%d.%H:%M:%S', time.localtime())
 
 MAX_THREADS = 30
 
+# hosts whose EDEX logs default to the local ones
+LOCAL_HOSTS = ('localhost', '127.0.0.1')
+
+scorecard_lock = Lock()
+
+INGEST_COMPLETE = 'EDEX - Ingest complete for file'
+
+# runtime of each test case in the previous runs, used to balance test cases across hosts
+RUNTIMES_FILE = os.path.join('.cache', 'runtimes.json')
+
+# fingerprints (input files, expected results, parser code and run options) of the test cases which passed
+LEDGER_FILE = os.path.join('.cache', 'ledger.json')
+
+# 'import a.b, c' and 'from a.b import (c, d)', the module and the imported names
+MODULE_IMPORT = re.compile(r'^[ \t]*import[ \t]+([\w., \t]+)', re.MULTILINE)
+FROM_IMPORT = re.compile(r'^[ \t]*from[ \t]+([\w.]+)[ \t]+import[ \t]+(\([^)]*\)|[^\n#;]+)', re.MULTILINE)
+
+# included in the expected results cache key, bump whenever get_expected changes the parsed results
+EXPECTED_CACHE_VERSION = 3
+
 startdir = os.path.join(edex_tools.edex_dir, 'data/utility/edex_static/base/ooi/parsers/mi-dataset/mi')
 drivers_dir = os.path.join(startdir, 'dataset/driver')
 ingest_dir = os.path.join(edex_tools.edex_dir, 'data', 'ooi')
@@ -50,9 +101,154 @@ output_dir = os.path.join(dataset_dir, 'output_%s' % time.strftime('%Y%m%d-%H%M%
 if not os.path.exists(output_dir):
     os.makedirs(output_dir)
 
+netcdf_dir = os.path.join(output_dir, 'netcdf')
+
 log = logger.get_logger(file_output=os.path.join(output_dir, 'everything.log'))
 
 
+class EdexHost(object):
+    """
+    EDEX instance test cases are run against
+    """
+    def __init__(self, spec):
+        """
+        :param spec:  host[:broker[:log_dir]], the log dir defaults to the local EDEX logs for localhost only
+        :raises ValueError: if a remote host has no log dir
+        """
+        parts = spec.split(':', 2)
+        self.hostname = parts[0]
+        self.broker = parts[1] if len(parts) > 1 and parts[1] else self.hostname
+        if len(parts) > 2 and parts[2]:
+            self.log_dir = parts[2]
+        elif self.hostname in LOCAL_HOSTS:
+            self.log_dir = edex_tools.log_dir
+        else:
+            raise ValueError('no log dir for remote host %s, expected host:broker:log_dir' % self.hostname)
+
+    def __str__(self):
+        return '%s (broker: %s, logs: %s)' % (self.hostname, self.broker, self.log_dir)
+
+
+def parse_hosts(specs):
+    """
+    :param specs:  comma separated host specs, see EdexHost
+    :return: list of EdexHost
+    :raises ValueError: if a host spec is invalid or two hosts share a log dir (each host's ingest messages
+                        are matched from its own log)
+    """
+    hosts = [EdexHost(spec) for spec in specs.split(',') if spec]
+    log_dirs = {}
+    for host in hosts:
+        log_dir = os.path.realpath(host.log_dir)
+        if log_dir in log_dirs:
+            raise ValueError('hosts %s and %s share the log dir %s' % (log_dirs[log_dir], host.hostname,
+                                                                      host.log_dir))
+        log_dirs[log_dir] = host.hostname
+    return hosts
+
+
+class IngestTracker(object):
+    """
+    Tracks the ingest complete message of every sent file and hands each test case to on_complete
+    as soon as all of its files are ingested, or its timeout expires.
+    """
+    def __init__(self, on_complete):
+        self.on_complete = on_complete
+        self.pending = {}
+        self.pending_names = {}
+        self.remaining = {}
+        self.deadlines = {}
+        self.sent_times = {}
+        self.unfinished = set()
+        self.lock = Lock()
+
+    def add(self, test_case, filename):
+        """
+        Register a file before sending it
+        """
+        with self.lock:
+            self.unfinished.add(test_case)
+            self.remaining[test_case] = self.remaining.get(test_case, 0) + 1
+            self.pending.setdefault(filename, []).append(test_case)
+            self.pending_names.setdefault(os.path.basename(filename), []).append(filename)
+
+    def remove(self, test_case, filename):
+        """
+        Unregister a file which could not be sent
+        """
+        with self.lock:
+            self.pending[filename].remove(test_case)
+            if not self.pending[filename]:
+                del self.pending[filename]
+            self.pending_names[os.path.basename(filename)].remove(filename)
+            self.remaining[test_case] -= 1
+
+    def sent(self, test_case):
+        """
+        All files of the test case have been sent, start its timeout
+        """
+        with self.lock:
+            self.unfinished.add(test_case)
+            self.sent_times[test_case] = time.time()
+            self.deadlines[test_case] = self.sent_times[test_case] + test_case.timeout
+            done = not self.remaining.get(test_case)
+        if done:
+            self._complete(test_case)
+
+    def file_ingested(self, line):
+        """
+        Log watcher callback for ingest complete messages
+        """
+        done = None
+        with self.lock:
+            filename = self._find_file(line)
+            if filename is None:
+                log.warn('Unable to match ingest message to a sent file: %s', line)
+                return
+
+            test_case = self.pending[filename].pop(0)
+            if not self.pending[filename]:
+                del self.pending[filename]
+            self.pending_names[os.path.basename(filename)].remove(filename)
+
+            self.remaining[test_case] -= 1
+            log.info('Ingested %s (%s, %d files remaining)', filename, test_case.instrument,
+                     self.remaining[test_case])
+            if self.remaining[test_case] == 0 and test_case in self.deadlines:
+                done = test_case
+        if done is not None:
+            self._complete(done)
+
+    def _find_file(self, line):
+        tokens = [token.strip('\'",;:()[]') for token in line.split()]
+        for token in tokens:
+            if token in self.pending:
+                return token
+        # fall back to the file name, in case EDEX reports a different path
+        for token in tokens:
+            filenames = self.pending_names.get(os.path.basename(token))
+            if filenames:
+                return filenames[0]
+
+    def check_timeouts(self):
+        now = time.time()
+        with self.lock:
+            expired = [tc for tc in self.unfinished if self.deadlines.get(tc, now) < now]
+        for tc in expired:
+            log.error('Timed out waiting for ingest complete message (%s, %d files remaining)',
+                      tc.instrument, self.remaining.get(tc, 0))
+            self._complete(tc)
+
+    def _complete(self, test_case):
+        with self.lock:
+            if test_case not in self.unfinished:
+                return
+            self.unfinished.remove(test_case)
+        timing.record('ingest_wait', self.sent_times.get(test_case, time.time()), time.time(),
+                      instrument=test_case.instrument, files=test_case.count)
+        self.on_complete(test_case)
+
+
 class TestCase(object):
     def __init__(self, config):
         self.config = config
@@ -66,8 +262,12 @@ class TestCase(object):
         self.timeout = config.get('timeout', edex_tools.DEFAULT_STANDARD_TIMEOUT)
         self.sensor = config.get('sensor')
         self.sensor_ids = []
-        self.expected = []
+        self.expected_files = []
         self.count = 0
+        self.host = None
+        self.fingerprint = None
+        self.start_time = None
+        self.runtime = None
 
     def __str__(self):
         return pprint.pformat(self.config)
@@ -87,22 +287,72 @@ def read_test_cases(f):
         yield TestCase(config)
 
 
+def read_expected_cache(cached_path):
+    try:
+        with open(cached_path, 'rb') as fh:
+            return cPickle.load(fh)
+    except (IOError, EOFError, cPickle.UnpicklingError) as e:
+        log.warn('Exception reading expected results cache (%s), parsing YML', e)
+
+
+def write_expected_cache(cached_path, expected_dictionary):
+    """
+    Atomically write the expected results cache file, removing stale entries for the same YAML file
+    """
+    dirname = os.path.dirname(cached_path)
+    # strip the .<digest>.pkl suffix
+    prefix = cached_path.rsplit('.', 2)[0]
+    try:
+        os.makedirs(dirname)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            log.warn('Unable to create cache dir %s: %s', dirname, e)
+            return
+
+    log.info('caching yml results for faster testing next run...')
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            cPickle.dump(expected_dictionary, fh, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, cached_path)
+    except (IOError, OSError) as e:
+        log.warn('Unable to write expected results cache %s: %s', cached_path, e)
+        return
+
+    for stale in glob.glob(prefix + '.*.pkl'):
+        if stale != cached_path:
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+
+
 def get_expected(filename, cache_dir='.cache'):
     """
-    Loads expected results from the supplied YAML file
+    Loads expected results from the supplied YAML file.
+    Results are cached by the content hash of the YAML file.
     :param filename:
     :return: list of records containing the expected results
     """
-    cached_path = os.path.join(cache_dir, filename.split('mi-dataset/')[1])
-    if os.path.exists(cached_path):
-        try:
-            return json.load(open(cached_path))
-        except:
-            log.warn('Exception reading JSON cache, parsing YML')
+    try:
+        with open(filename, 'rb') as fh:
+            contents = fh.read()
+    except IOError:
+        contents = None
+
+    cached_path = None
+    if contents is not None:
+        digest = hashlib.sha1('%d\n%s' % (EXPECTED_CACHE_VERSION, contents)).hexdigest()
+        cached_path = os.path.join(cache_dir, '%s.%s.pkl' % (filename.split('mi-dataset/')[1], digest))
+        if os.path.exists(cached_path):
+            expected_dictionary = read_expected_cache(cached_path)
+            if expected_dictionary is not None:
+                return expected_dictionary
 
     try:
-        fh = open(filename, 'r')
-        data = load(fh)
+        if contents is None:
+            raise IOError('Unable to read %s' % filename)
+        data = load(contents, Loader=ExpectedLoader)
         log.debug('Raw data from YAML: %s', data)
         header = data.get('header')
         data = data.get('data')
@@ -114,57 +364,292 @@ def get_expected(filename, cache_dir='.cache'):
     except (IOError, KeyError):
         data = []
 
-    for record in data:
-        timestamp = record.get('internal_timestamp')
-        if type(timestamp) == str:
-            if not timestamp.endswith('Z'):
-                timestamp += 'Z'
-            # Check to see if we have a timestamp with a decimal point which
-            # means we have the millis included
-            if '.' in timestamp:
-                timestamp_to_use = timestamp
-            else:
-                # So now we will add the millis, eliminating the Z (i.e. [:-1])
-                # and reappend the Z
-                timestamp_to_use = timestamp[:-1] + '.0Z'
-            dt = datetime.strptime(timestamp_to_use, '%Y-%m-%dT%H:%M:%S.%fZ')
-            timestamp = ntplib.system_to_ntp_time(
-                calendar.timegm(dt.timetuple()) + (dt.microsecond / 1000000.0))
+    # convert all the timestamp strings at once
+    timestamped = [record for record in data if isinstance(record.get('internal_timestamp'), basestring)]
+    strings = [record['internal_timestamp'] for record in timestamped]
+    timestamps, bad = time_util.iso8601_to_ntp(strings)
+    for record, timestamp, invalid in zip(timestamped, timestamps.tolist(), bad.tolist()):
+        # unparseable timestamps can't be matched, compare reports them as invalid
+        record['internal_timestamp'] = None if invalid else timestamp
 
-            record['internal_timestamp'] = timestamp
+    if bad.any():
+        log.error('Unable to parse %d internal_timestamp values in %s, e.g. %r',
+                  bad.sum(), filename, strings[bad.argmax()])
 
     expected_dictionary = {}
 
     for record in data:
         expected_dictionary.setdefault(record.get('particle_type'), []).append(record)
 
-    dirname = os.path.dirname(cached_path)
-    log.info('caching yml results for faster testing next run...')
-    # only allow one thread to write a cache file at a time
-    with rlock:
-        try:
-            if not os.path.exists(dirname):
-                log.info('creating dir: %s', dirname)
-                os.makedirs(dirname)
-            json.dump(expected_dictionary, open(cached_path, 'wb'))
-        except OSError:
-            pass
+    if cached_path is not None:
+        write_expected_cache(cached_path, expected_dictionary)
 
     return expected_dictionary
 
 
-def test_results(expected, stream_name, sensor, method):
+def load_case_expected(pool, tc):
+    """
+    Start parsing the expected results of a test case in a pool of processes
+    :return: list of AsyncResult of the expected results (None for missing files), one per pair
+    """
+    return [pool.apply_async(get_expected, (f,)) if f is not None else None for f in tc.expected_files]
+
+
+def read_json(filename):
+    try:
+        with open(filename) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_json(filename, data):
+    """
+    Atomically replace a JSON file
+    """
+    dirname = os.path.dirname(filename)
+    try:
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        fd, temp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(data, fh, indent=1, sort_keys=True)
+        os.rename(temp_path, filename)
+    except (IOError, OSError) as e:
+        log.warn('Unable to write %s: %s', filename, e)
+
+
+def read_runtimes():
+    """
+    :return: dictionary of instrument -> runtime in seconds of the previous runs
+    """
+    return read_json(RUNTIMES_FILE)
+
+
+def write_runtimes(my_test_cases):
+    runtimes = read_runtimes()
+    for tc in my_test_cases:
+        if tc.runtime is not None:
+            runtimes[tc.instrument] = tc.runtime
+    write_json(RUNTIMES_FILE, runtimes)
+
+
+def hash_file(filename):
+    """
+    :return: SHA1 of the file contents, None if the file can't be read
+    """
+    h = hashlib.sha1()
+    try:
+        with open(filename, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1024 * 1024), ''):
+                h.update(chunk)
+    except IOError:
+        return None
+    return h.hexdigest()
+
+
+def module_path(module, directory):
+    """
+    :param module:  dotted module name, either an mi.dataset module or a sibling of the importing file
+    :param directory:  directory of the importing file
+    :return: path of the module source, or None if it is not part of the dataset code
+    """
+    if module.startswith('mi.dataset.'):
+        base = os.path.join(os.path.dirname(startdir), *module.split('.'))
+    elif '.' not in module:
+        base = os.path.join(directory, module)
+    else:
+        return None
+    for path in (base + '.py', os.path.join(base, '__init__.py')):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def imported_modules(source):
+    """
+    :return: names of the modules (and names possibly modules) imported by the source
+    """
+    modules = []
+    for names in MODULE_IMPORT.findall(source):
+        modules.extend(name.split()[0] for name in names.split(',') if name.strip())
+    for module, names in FROM_IMPORT.findall(source):
+        modules.append(module)
+        # from package import module
+        for name in names.strip('()').split(','):
+            name = name.split()
+            if name and name[0] != '*':
+                modules.append('%s.%s' % (module, name[0]))
+    return modules
+
+
+def driver_files(resource):
+    """
+    Find the code a test case depends on, the driver modules and the dataset modules they import, transitively
+    :param resource:  driver resource directory
+    :return: sorted list of paths
+    """
+    files = set(glob.glob(os.path.join(os.path.dirname(resource), '*.py')))
+    pending = list(files)
+    while pending:
+        filename = pending.pop()
+        try:
+            with open(filename) as fh:
+                modules = imported_modules(fh.read())
+        except IOError:
+            continue
+        for module in modules:
+            path = module_path(module, os.path.dirname(filename))
+            if path is not None and path not in files:
+                files.add(path)
+                pending.append(path)
+    return sorted(files)
+
+
+def run_options():
+    """
+    :return: the options which change the result of a test case
+    """
+    return {'ignore_nulls': IGNORE_NULLS, 'netcdf': NETCDF, 'time_tolerance': TIME_TOLERANCE,
+            'windows': RETRIEVAL_WINDOWS}
+
+
+def test_case_fingerprint(tc):
+    """
+    Hash everything the result of a test case depends on, the input files, expected results, parser code
+    and run options
+    """
+    h = hashlib.sha1(tc.instrument)
+    h.update('%s\n' % json.dumps(run_options(), sort_keys=True))
+    for test_file, yaml_file in tc.pairs:
+        for filename in (test_file, yaml_file):
+            h.update('%s %s\n' % (filename, hash_file(os.path.join(drivers_dir, tc.resource, filename))))
+    for filename in driver_files(tc.resource):
+        h.update('%s %s\n' % (os.path.relpath(filename, startdir), hash_file(filename)))
+    return h.hexdigest()
+
+
+def passed(results):
+    """
+    :param results:  scorecard entry of one instrument
+    :return: True if every stream of every pair retrieved all expected records without failures
+    """
+    if not results:
+        return False
+    for test_file in results.itervalues():
+        for yaml_file in test_file.itervalues():
+            for results in yaml_file.itervalues():
+                edex_count, yaml_count, failures = results[:3]
+                if failures or edex_count != yaml_count:
+                    return False
+    return True
+
+
+def skip_unchanged(my_test_cases, ledger):
+    """
+    Split off the test cases unchanged since a passing run
+    :return: (test cases to run, scorecard of the previous results of the skipped test cases)
+    """
+    remaining = []
+    sc = {}
+    for tc in my_test_cases:
+        entry = ledger.get(tc.fingerprint)
+        if entry is not None and not FULL:
+            log.info('Skipping unchanged test case %s (passed %s)', tc.instrument, entry['time'])
+            sc[tc.instrument] = entry['scorecard']
+        else:
+            remaining.append(tc)
+    log.info('Running %d test cases, %d unchanged since passing', len(remaining), len(sc))
+    return remaining, sc
+
+
+def update_ledger(ledger, my_test_cases, sc):
+    """
+    Record the fingerprints of the test cases which passed, dropping those which failed
+    """
+    for tc in my_test_cases:
+        # only the latest fingerprint of each instrument is kept
+        for fingerprint, entry in ledger.items():
+            if entry['instrument'] == tc.instrument:
+                del ledger[fingerprint]
+
+        if tc.count == len(tc.pairs) and passed(sc.get(tc.instrument)):
+            ledger[tc.fingerprint] = {'instrument': tc.instrument,
+                                      'time': VALIDATE_TIMESTAMP,
+                                      'scorecard': sc[tc.instrument]}
+    write_json(LEDGER_FILE, ledger)
+
+
+def assign_hosts(my_test_cases, hosts):
+    """
+    Shard the test cases across hosts, longest (by previous runtime) first onto the least loaded host.
+    Test cases without a previous runtime are assumed to take the mean runtime.
+    """
+    runtimes = read_runtimes()
+    known = [runtimes[tc.instrument] for tc in my_test_cases if tc.instrument in runtimes]
+    default = sum(known) / len(known) if known else edex_tools.DEFAULT_STANDARD_TIMEOUT
+
+    loads = [(0, index, host) for index, host in enumerate(hosts)]
+    for tc in sorted(my_test_cases, key=lambda x: runtimes.get(x.instrument, default), reverse=True):
+        load, index, host = heapq.heappop(loads)
+        tc.host = host
+        heapq.heappush(loads, (load + runtimes.get(tc.instrument, default), index, host))
+
+    for load, _, host in sorted(loads, key=lambda x: x[1]):
+        log.info('Host %s: %d test cases, estimated %.0f secs', host,
+                 len([tc for tc in my_test_cases if tc.host is host]), load)
+
+
+def test_results(expected, stream_name, sensor, method, hostname='localhost'):
     subsite, node, sensor = sensor.split('-', 3)
     start = ntplib.system_to_ntp_time(1)
     stop = 1e10
 
     stream_code = '%s_%s_%s' % (stream_name, sensor, method)
 
+    population = None
+    if SAMPLE_SIZE:
+        rng = random.Random(int(hashlib.sha1('%s %s %s' % (SEED, stream_name, method)).hexdigest(), 16))
+        expected, untimed = edex_tools.split_timed(expected)
+        if untimed:
+            log.warn('Excluded %d expected records without a valid internal_timestamp from the sample (%s)',
+                     len(untimed), stream_code)
+        population = len(expected)
+        expected = edex_tools.stratified_sample(expected, SAMPLE_SIZE, rng)
+        log.info('Sampled %d of %d expected records (%s)', len(expected), population, stream_code)
+
     log.info('Retrieving data (%s)', stream_code)
     now = time.time()
-    metadata = edex_tools.get_edex_metadata('localhost', subsite, node, sensor)
-    retrieved = edex_tools.get_from_edex('localhost', subsite, node, sensor, method,
-                                         stream_name, start, stop, timestamp_as_string=True)
+    metadata = edex_tools.get_edex_metadata(hostname, subsite, node, sensor)
+
+    if NETCDF:
+        netcdf_file = edex_tools.get_netcdf_from_edex(hostname, subsite, node, sensor, method,
+                                                      stream_name, start, stop, output_dir=netcdf_dir)
+        ds = edex_tools.open_netcdf(netcdf_file)
+        try:
+            retrieved_count = ds.dims.get('obs', 0)
+            elapsed = time.time() - now
+            log.info('Retrieved %d records (%s) in %.4f secs', retrieved_count, stream_code, elapsed)
+
+            now = time.time()
+            with timing.span('compare', records=retrieved_count):
+                failures = edex_tools.compare_columnar(ds, expected, metadata, ignore_nulls=IGNORE_NULLS,
+                                                       time_tolerance=TIME_TOLERANCE)
+        finally:
+            ds.close()
+        elapsed = time.time() - now
+        log.info('Compared %d records (%s) in %.4f secs', retrieved_count, stream_code, elapsed)
+        return scorecard_results(retrieved_count, expected, failures, population)
+
+    if population is not None:
+        retrieved = edex_tools.get_sample_from_edex(hostname, subsite, node, sensor, method, stream_name,
+                                                    [record['internal_timestamp'] for record in expected])
+    else:
+        retrieved = edex_tools.get_from_edex(hostname, subsite, node, sensor, method,
+                                             stream_name, start, stop, windows=RETRIEVAL_WINDOWS)
+        # each stream is only retrieved once per run, keep it on disk (if enabled) but not in memory
+        edex_tools.results_cache.discard(edex_tools.edex_results_key(hostname, subsite, node, sensor, method,
+                                                                     stream_name, start, stop))
     elapsed = time.time() - now
     retrieved_count = 0
     for each in retrieved.itervalues():
@@ -176,10 +661,28 @@ def test_results(expected, stream_name, sensor, method):
     log.debug('Retrieved %d records from expected data file:', len(expected))
     log.debug(pprint.pformat(expected, depth=3))
     now = time.time()
-    failures = edex_tools.compare(retrieved, expected, metadata, ignore_nulls=IGNORE_NULLS)
+    with timing.span('compare', records=retrieved_count):
+        failures = edex_tools.compare(retrieved, expected, metadata, ignore_nulls=IGNORE_NULLS,
+                                      time_tolerance=TIME_TOLERANCE)
     elapsed = time.time() - now
     log.info('Compared %d records (%s) in %.4f secs', retrieved_count, stream_code, elapsed)
-    return retrieved_count, len(expected), failures
+    return scorecard_results(retrieved_count, expected, failures, population)
+
+
+def scorecard_results(retrieved_count, expected, failures, population=None):
+    """
+    :param population:  number of expected records the sample was taken from, None if not sampled
+    :return: scorecard entry of one stream
+    """
+    if population is None:
+        return retrieved_count, len(expected), failures
+    return retrieved_count, len(expected), failures, population
+
+
+def write_rows(fh, data):
+    for row in data:
+        row = [str(x) for x in row]
+        fh.write(','.join(row) + '\n')
 
 
 def dump_csv(data):
@@ -189,13 +692,65 @@ def dump_csv(data):
     :return:  none
     """
     fh = open(os.path.join(output_dir, 'results.csv'), 'w')
-    for row in data:
-        row = [str(x) for x in row]
-        fh.write(','.join(row) + '\n')
+    write_rows(fh, data)
     fh.close()
 
 
-def execute_test(test_case):
+def dump_test_case_csv(sc):
+    """
+    Append the scorecard rows of one evaluated test case to scorecard.csv, in order of completion.
+    :param sc:  scorecard of the test case
+    """
+    _, table_data = edex_tools.parse_scorecard(sc)
+    filename = os.path.join(output_dir, 'scorecard.csv')
+    with scorecard_lock:
+        if os.path.exists(filename):
+            table_data = table_data[1:]
+        with open(filename, 'a') as fh:
+            write_rows(fh, table_data)
+
+
+def compact_scorecard(sc):
+    """
+    Replace the failures of each stream with their number, the details have already been logged
+    """
+    for test_files in sc.itervalues():
+        for yaml_files in test_files.itervalues():
+            for streams in yaml_files.itervalues():
+                for stream, results in streams.iteritems():
+                    streams[stream] = (results[0], results[1], len(results[2])) + tuple(results[3:])
+    return sc
+
+
+def log_peak_memory():
+    """
+    Log the peak resident memory of this process and of the expected results worker processes
+    (only worker processes which have exited and been reaped are counted)
+    """
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    log.info('Peak memory: %.1f MB (largest worker process: %.1f MB)', peak, workers)
+
+
+def dump_timing():
+    """
+    Save the phase timing spans as JSON lines and log the slowest instruments and streams.
+    """
+    timing.write_spans(os.path.join(output_dir, 'timing.jsonl'))
+    log.info(timing.format_summary())
+
+
+def execute_test(test_case, tracker):
+    test_case.start_time = time.time()
+    try:
+        with timing.context(instrument=test_case.instrument), timing.span('send'):
+            send_test_files(test_case, tracker)
+    finally:
+        tracker.sent(test_case)
+
+
+def send_test_files(test_case, tracker):
     index = random.randint(0, 999)
     log.debug('Processing test case: %s index: %d', test_case, index)
     test_case.count = 0
@@ -219,71 +774,107 @@ def execute_test(test_case):
 
             try:
                 log.info('Sending file (%s) to queue (%s)', test_file, queue)
-                edex_tools.send_file_to_queue(input_filepath, queue, delivery, sensor, 1)
+                tracker.add(test_case, input_filepath)
+                edex_tools.send_file_to_queue(input_filepath, queue, delivery, sensor, 1,
+                                              hostname=test_case.host.broker)
             except NotFound:
                 log.warn('Queue not found: %s', queue)
+                tracker.remove(test_case, input_filepath)
                 return None
 
-            log.info('Fetching expected results from YML file: %s', yaml_file)
             test_case.sensor_ids.append(sensor)
-            test_case.expected.append(get_expected(output_filepath))
+            test_case.expected_files.append(output_filepath)
             test_case.count += 1
 
         else:
             log.error('Missing test data or results: %s %s', input_filepath, output_filepath)
             test_case.sensor_ids.append(None)
-            test_case.expected.append(None)
+            test_case.expected_files.append(None)
 
 
-def evaluate_test_case(tc):
+def evaluate_test_case(tc, yaml_pool):
+    """
+    Evaluate a test case once its files are ingested.  The expected results are only loaded now and
+    each file's results are released once compared, only the compacted scorecard is kept.
+    :return: scorecard of the test case
+    """
     log.info('Evaluating test case: %s', tc.instrument)
     sc = {}
     method = tc.instrument.split('_')[-1]
     try:
+        expected_results = load_case_expected(yaml_pool, tc)
         for index, sensor in enumerate(tc.sensor_ids):
-            expected = tc.expected[index]
             if sensor is not None:
+                expected = expected_results[index].get()
+                expected_results[index] = None
                 for stream in expected:
-                    results = test_results(expected[stream], stream, sensor, method)
+                    with timing.context(instrument=tc.instrument, stream=stream):
+                        results = test_results(expected[stream], stream, sensor, method,
+                                               hostname=tc.host.hostname)
                     sc.setdefault(tc.instrument, {}) \
                         .setdefault(tc.pairs[index][0], {}) \
                         .setdefault(tc.pairs[index][1], {})[stream] = results
+                del expected
 
     except Exception as e:
         import traceback
         traceback.print_exc()
         log.error('Exception processing test case %r: %s', tc, e)
-    return sc
+    tc.runtime = time.time() - tc.start_time
 
+    if sc:
+        dump_test_case_csv(sc)
+    return compact_scorecard(sc)
 
-def test(my_test_cases):
-    try:
-        logfile = edex_tools.find_latest_log()
-    except OSError as e:
-        log.error('Error fetching latest log file - %s', e)
-        return {}
 
-    total_timeout = 0
-    count = 0
+def test(my_test_cases, hosts):
+    """
+    Run the test cases sharded across the EDEX hosts
+    :return: scorecard merged from all hosts
+    """
     sc = {}
-    pool = ThreadPool(MAX_THREADS)
-
-    pool.map(execute_test, my_test_cases)
-
-    for tc in my_test_cases:
-        total_timeout += tc.timeout
-        count += tc.count
-
-    # wait for all ingestion to complete
-    if not edex_tools.watch_log_for('EDEX - Ingest complete for file', logfile=logfile,
-                                    expected_count=count, timeout=total_timeout):
-        log.error('Timed out waiting for ingest complete message')
-
-    log.info('All files ingested, testing results')
-
-    for tc in pool.map(evaluate_test_case, test_cases):
-        sc.update(tc)
-
+    assign_hosts(my_test_cases, hosts)
+
+    # parses the expected results of each test case in other processes when it is evaluated
+    # (created first, before this process starts any threads)
+    yaml_pool = Pool(YAML_WORKERS)
+    pool = ThreadPool(MAX_THREADS * len(hosts))
+
+    # each test case is evaluated as soon as all of its files are ingested
+    evaluations = []
+    trackers = {}
+    subscriptions = []
+    for host in hosts:
+        tracker = IngestTracker(lambda tc: evaluations.append(pool.apply_async(evaluate_test_case,
+                                                                               (tc, yaml_pool))))
+        trackers[host] = tracker
+
+        # subscribe before sending so no ingest messages are missed
+        tailer = edex_tools.get_log_tailer(directory=host.log_dir)
+        watcher = tailer.subscribe(INGEST_COMPLETE, expected_count=None, callback=tracker.file_ingested)
+        subscriptions.append((tailer, watcher))
+
+    pool.map(lambda tc: execute_test(tc, trackers[tc.host]), my_test_cases)
+    edex_tools.sync_queues()
+
+    while any(tracker.unfinished for tracker in trackers.itervalues()):
+        for tracker in trackers.itervalues():
+            tracker.check_timeouts()
+        time.sleep(1)
+
+    for tailer, watcher in subscriptions:
+        tailer.unsubscribe(watcher)
+    log.info('All files ingested')
+
+    for evaluation in evaluations:
+        sc.update(evaluation.get())
+
+    # joined so the worker processes are reaped, RUSAGE_CHILDREN (see log_peak_memory) only counts those
+    yaml_pool.close()
+    yaml_pool.join()
+    pool.close()
+    pool.join()
+    write_runtimes(my_test_cases)
     return sc
 
 
@@ -291,6 +882,19 @@ if __name__ == '__main__':
     options = docopt.docopt(__doc__)
 
     IGNORE_NULLS = options['--ignore_null']
+    RETRIEVAL_WINDOWS = int(options['--windows'])
+    TIME_TOLERANCE = int(options['--time_tolerance'])
+    NETCDF = options['--netcdf']
+    YAML_WORKERS = int(options['--yaml_workers']) or None
+    try:
+        hosts = parse_hosts(options['--hosts'])
+    except ValueError as e:
+        raise docopt.DocoptExit('invalid --hosts: %s' % e)
+    FULL = options['--full']
+    SAMPLE_SIZE = int(options['--sample'])
+    SEED = options['--seed']
+    if NETCDF and not os.path.exists(netcdf_dir):
+        os.makedirs(netcdf_dir)
 
     test_cases = []
     if not options['<test_case>']:
@@ -299,8 +903,21 @@ if __name__ == '__main__':
         for each in options['<test_case>']:
             test_cases.extend(list(read_test_cases(each)))
 
-    scorecard = test(test_cases)
+    for tc in test_cases:
+        tc.fingerprint = test_case_fingerprint(tc)
+    ledger = read_json(LEDGER_FILE)
+    test_cases, scorecard = skip_unchanged(test_cases, ledger)
+
+    if test_cases:
+        results = test(test_cases, hosts)
+        # a sampled run doesn't validate every record, so it doesn't count as passing
+        if not SAMPLE_SIZE:
+            update_ledger(ledger, test_cases, results)
+        scorecard.update(results)
 
     result, table_data = edex_tools.parse_scorecard(scorecard)
     log.info(result)
     dump_csv(table_data)
+    dump_timing()
+    edex_tools.results_cache.log_stats()
+    log_peak_memory()
@@ -99,19 +99,20 @@ def load_files(resource, instrument, test_file, sensor):
     return num_files
 
 
-def purge_edex(logfile=None):
+def purge_edex():
+    tailer = edex_tools.get_log_tailer()
+    watcher = tailer.subscribe('Purge Operation: PURGE_ALL_DATA completed')
     edex_tools.purge_edex()
-    return edex_tools.watch_log_for('Purge Operation: PURGE_ALL_DATA completed', logfile=logfile)
+    try:
+        return watcher.wait(DEFAULT_STANDARD_TIMEOUT)
+    finally:
+        tailer.unsubscribe(watcher)
 
 
 def test(test_cases):
-    try:
-        logfile = edex_tools.find_latest_log()
-    except OSError as e:
-        log.error('Error fetching latest log file - %s', e)
-        return
-
-    purge_edex(logfile)
+    purge_edex()
+    tailer = edex_tools.get_log_tailer()
+    watcher = tailer.subscribe('Ingest: EDEX: Ingest', expected_count=None)
 
     last_instrument = None
     num_files = 0
@@ -128,11 +129,13 @@ def test(test_cases):
 
         for source in test_case.source_data:
             num_files += load_files(test_case.resource, test_case.endpoint, source, sensor)
+    edex_tools.sync_queues()
 
-    if not edex_tools.watch_log_for('Ingest: EDEX: Ingest', logfile=logfile,
-                                    timeout=total_timeout, expected_count=num_files):
+    watcher.set_expected_count(num_files)
+    if not watcher.wait(total_timeout):
         log.error('Timed out waiting for ingest complete message')
         time.sleep(1)
+    tailer.unsubscribe(watcher)
 
     mio_analysis(hostname='localhost', output_dir=output_dir)
 